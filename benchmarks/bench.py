@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+'''
+Benchmark lgit.py on a synthetic repository.
+
+    python3 benchmarks/bench.py --preset 10k -o after.json
+    python3 benchmarks/bench.py --preset 10k --compare after.json
+
+A repository is generated in a temporary directory from a seed, so two runs
+with the same options work on the same files. Each lgit command runs as a
+subprocess; wall time, user and system time and peak RSS are reported for
+every step as JSON. With --syscalls, commands run under `strace -c` and
+their system call count is reported too (times then include the tracing).
+'''
+
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+LGIT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'lgit.py')
+
+PRESETS = {
+    '1k': {'files': 1000, 'depth': 3, 'size': 4096},
+    '10k': {'files': 10000, 'depth': 4, 'size': 4096},
+    '100k': {'files': 100000, 'depth': 5, 'size': 2048},
+}
+
+
+def make_content(rand, size, binary):
+    if binary:
+        return rand.randbytes(size)
+    words = [b'lorem', b'ipsum', b'dolor', b'sit', b'amet', b'lgit',
+             b'index', b'commit', b'object', b'tree']
+    lines = []
+    length = 0
+    while length < size:
+        line = b' '.join(rand.choice(words)
+                         for i in range(rand.randint(1, 12))) + b'\n'
+        lines.append(line)
+        length += len(line)
+    return b''.join(lines)[:size]
+
+
+def get_size(rand, mean):
+    # sizes follow a log-normal distribution: many small files, a few big
+    return max(0, min(int(rand.lognormvariate(0, 1) * mean / 1.65),
+                      mean * 64))
+
+
+def generate(root, options):
+    # write options.files files spread over directories up to options.depth
+    # deep, return their paths
+    rand = random.Random(options.seed)
+    dirs = ['']
+    names = []
+    for i in range(options.files):
+        # about 16 files per directory
+        if i % 16 == 0 and i:
+            parent = rand.choice(dirs)
+            if parent.count('/') < options.depth:
+                dirs.append('%sd%d/' % (parent, len(dirs)))
+        name = '%sf%d' % (rand.choice(dirs), i)
+        binary = rand.random() < options.binary_ratio
+        os.makedirs(os.path.join(root, os.path.dirname(name)), exist_ok=True)
+        file = open(os.path.join(root, name), 'wb')
+        file.write(make_content(rand, get_size(rand, options.size), binary))
+        file.close()
+        names.append(name)
+    return names
+
+
+def edit(root, names, options, round):
+    # rewrite the end of options.edit_rate of the files and add a few new
+    rand = random.Random('%d-%d' % (options.seed, round))
+    for name in rand.sample(names, int(len(names) * options.edit_rate)):
+        file = open(os.path.join(root, name), 'ab')
+        file.write(make_content(rand, 64, False))
+        file.close()
+    for i in range(max(1, int(len(names) * options.edit_rate / 10))):
+        file = open(os.path.join(root, 'new-%d-%d' % (round, i)), 'wb')
+        file.write(make_content(rand, get_size(rand, options.size), False))
+        file.close()
+
+
+def run(root, args, options):
+    # run lgit with args in root, return its measures
+    command = [sys.executable, 'lgit.py'] + args
+    trace_path = None
+    if options.syscalls:
+        trace_path = os.path.join(root, '.strace')
+        command = ['strace', '-f', '-c', '-o', trace_path] + command
+    env = dict(os.environ, LOGNAME='bench')
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=root, env=env,
+                               stdout=subprocess.DEVNULL)
+    status, rusage = os.wait4(process.pid, 0)[1:]
+    wall = time.perf_counter() - start
+    if os.waitstatus_to_exitcode(status):
+        sys.exit('lgit %s failed' % ' '.join(args))
+    result = {'command': ' '.join(args), 'wall': round(wall, 4),
+              'user': round(rusage.ru_utime, 4),
+              'sys': round(rusage.ru_stime, 4),
+              'max_rss': rusage.ru_maxrss * 1024, 'syscalls': None}
+    if trace_path:
+        file = open(trace_path, 'r')
+        for line in file:
+            fields = line.split()
+            if fields and fields[-1] == 'total':
+                result['syscalls'] = int(fields[3])
+        file.close()
+        os.remove(trace_path)
+    return result
+
+
+def benchmark(options):
+    root = tempfile.mkdtemp(prefix='lgit-bench-')
+    try:
+        shutil.copy(LGIT, root)
+        names = generate(root, options)
+        # lgit.py itself is not part of the measured tree
+        file = open(os.path.join(root, '.lgitignore'), 'w')
+        file.write('/lgit.py\n')
+        file.close()
+        jobs = ['-j', str(options.jobs)] if options.jobs else []
+        results = []
+        steps = [
+            ['init'],
+            ['add', '.'] + jobs,
+            ['status'],
+            ['commit', '-m', 'first'],
+            ['branch', 'base'],
+            'edit',
+            ['status'],
+            ['add', '.'] + jobs,
+            ['commit', '-m', 'second'],
+            ['log'],
+            ['branch'],
+            ['checkout', 'base'],
+            ['checkout', 'master'],
+            'edit',
+            ['add', '.'] + jobs,
+            ['stash'],
+        ]
+        round = 0
+        for step in steps:
+            if step == 'edit':
+                round += 1
+                edit(root, names, options, round)
+            else:
+                results.append(run(root, step, options))
+        return results
+    finally:
+        if options.keep:
+            print('repository kept in ' + root, file=sys.stderr)
+        else:
+            shutil.rmtree(root)
+
+
+def compare(baseline, report):
+    # print each step's wall time against the baseline's
+    old = {}
+    for result in baseline['results']:
+        old.setdefault(result['command'], []).append(result)
+    print('%-30s %10s %10s %8s' % ('command', 'baseline', 'now', 'ratio'))
+    for result in report['results']:
+        before = old.get(result['command'])
+        if not before:
+            continue
+        base = before.pop(0)['wall']
+        print('%-30s %10.3f %10.3f %7.2fx'
+              % (result['command'], base, result['wall'],
+                 result['wall'] / base if base else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark lgit.py.')
+    parser.add_argument('--preset', choices=sorted(PRESETS))
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--depth', type=int, default=3,
+                        help='maximum depth of directories')
+    parser.add_argument('--size', type=int, default=4096,
+                        help='mean file size in bytes')
+    parser.add_argument('--binary-ratio', type=float, default=0.1)
+    parser.add_argument('--edit-rate', type=float, default=0.05,
+                        help='ratio of files changed between commits')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='run the whole benchmark this many times')
+    parser.add_argument('--syscalls', action='store_true',
+                        help='count system calls with strace')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the generated repository')
+    parser.add_argument('-o', '--output', help='write the JSON report here')
+    parser.add_argument('--compare', metavar='REPORT',
+                        help='compare wall times with an earlier report')
+    options = parser.parse_args()
+    if options.preset:
+        for key, value in PRESETS[options.preset].items():
+            setattr(options, key, value)
+    if options.syscalls and not shutil.which('strace'):
+        sys.exit('--syscalls needs strace')
+
+    report = {
+        'params': {key: getattr(options, key) for key in
+                   ['files', 'depth', 'size', 'binary_ratio', 'edit_rate',
+                    'seed', 'jobs']},
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'runs': [],
+    }
+    for i in range(options.repeat):
+        report['runs'].append(benchmark(options))
+    # the best of the runs is kept for each step
+    report['results'] = [min(step, key=lambda result: result['wall'])
+                         for step in zip(*report['runs'])]
+
+    content = json.dumps(report, indent=2)
+    if options.output:
+        file = open(options.output, 'w')
+        file.write(content + '\n')
+        file.close()
+    elif not options.compare:
+        print(content)
+    if options.compare:
+        file = open(options.compare, 'r')
+        compare(json.load(file), report)
+        file.close()
+
+
+if __name__ == '__main__':
+    main()
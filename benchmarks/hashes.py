@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+'''
+Measure the throughput of the hash algorithms `lgit init --hash` offers.
+
+    python3 benchmarks/hashes.py --preset 10k
+
+The files are generated like bench.py does, then read once so they are in
+the page cache, and every algorithm hashes all of them block by block the
+way lgit does. The report is JSON with MB/s per algorithm.
+'''
+
+import sys
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import bench  # noqa: E402
+import lgit  # noqa: E402
+
+
+def hash_files(paths, new):
+    for path in paths:
+        hasher = new()
+        file = open(path, 'rb')
+        block = file.read(lgit.BLOCK_SIZE)
+        while block:
+            hasher.update(block)
+            block = file.read(lgit.BLOCK_SIZE)
+        file.close()
+        hasher.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark hash '
+                                     'algorithms on a file mix.')
+    parser.add_argument('--preset', choices=sorted(bench.PRESETS))
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=65536,
+                        help='mean file size in bytes')
+    parser.add_argument('--binary-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    options = parser.parse_args()
+    if options.preset:
+        for key, value in bench.PRESETS[options.preset].items():
+            setattr(options, key, value)
+    options.depth = 3
+
+    root = tempfile.mkdtemp(prefix='lgit-hashes-')
+    try:
+        paths = [os.path.join(root, name)
+                 for name in bench.generate(root, options)]
+        size = sum(os.path.getsize(path) for path in paths)
+        hash_files(paths, lgit.HASH_ALGORITHMS['sha1'])
+        results = {}
+        for name, new in lgit.HASH_ALGORITHMS.items():
+            best = None
+            for i in range(options.repeat):
+                start = time.perf_counter()
+                hash_files(paths, new)
+                wall = time.perf_counter() - start
+                best = wall if best is None else min(best, wall)
+            results[name] = {'wall': round(best, 4),
+                             'mb_per_s': round(size / best / 1e6, 1)}
+    finally:
+        shutil.rmtree(root)
+    print(json.dumps({'files': len(paths), 'bytes': size,
+                      'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ import sys
 import os
 import hashlib
 import time
+import tempfile
 import datetime
 import calendar
 
@@ -44,11 +45,40 @@ def lgit_init():
         print('Git repository already initialized.')
 
 
+# files are hashed and copied in blocks of this size
+BLOCK_SIZE = 1024 * 1024
+
+
 def get_hash(filename):
-    # get content and sha1 value of file
+    # get sha1 value of file, read block by block
+    sha1 = hashlib.sha1()
     fd = os.open(filename, os.O_RDONLY)
-    content = os.read(fd, os.stat(filename).st_size)
-    return content, hashlib.sha1(content).hexdigest()
+    block = os.read(fd, BLOCK_SIZE)
+    while block:
+        sha1.update(block)
+        block = os.read(fd, BLOCK_SIZE)
+    os.close(fd)
+    return sha1.hexdigest()
+
+
+def store_file(filename):
+    # hash filename and copy it into the object store in a single pass
+    sha1 = hashlib.sha1()
+    tmp_fd, tmp_path = tempfile.mkstemp(dir='.lgit/objects')
+    fd = os.open(filename, os.O_RDONLY)
+    block = os.read(fd, BLOCK_SIZE)
+    while block:
+        sha1.update(block)
+        os.write(tmp_fd, block)
+        block = os.read(fd, BLOCK_SIZE)
+    os.close(fd)
+    os.close(tmp_fd)
+    hash_value = sha1.hexdigest()
+    dir_name = '.lgit/objects/%s/' % hash_value[:2]
+    if not os.path.exists(dir_name):
+        os.mkdir(dir_name)
+    os.replace(tmp_path, dir_name + hash_value[2:])
+    return hash_value
 
 
 def get_files(dir_name):
@@ -84,18 +114,11 @@ def lgit_add(filenames):
                 names += get_files(name)
 
     for name in names:
-        content, hash_value = get_hash(name)
+        # create a file which store content in SHA1 value of current file
+        hash_value = store_file(name)
         tim = datetime.datetime.fromtimestamp(time.time())
         tstamp = tim.strftime("%Y%m%d%H%M%S")
 
-        # create a file which store content in SHA1 value of current file
-        dir_name = '.lgit/objects/%s/' % hash_value[:2]
-        if not os.path.exists(dir_name):
-            os.mkdir(dir_name)
-        fd = os.open(dir_name + hash_value[2:], os.O_CREAT | os.O_WRONLY)
-        os.write(fd, content)
-        os.close(fd)
-
         # update file index
         file_index = open('.lgit/index', 'r')
         index_content = file_index.readlines()
@@ -148,9 +171,6 @@ def lgit_rm(filenames):
             print('fatal: not removing \'%s\' recursively' % filename)
             exit()
         if os.path.exists(filename):
-            content, hash_value = get_hash(filename)
-            dir = hash_value[:2]
-            file = hash_value[2:]
             flag = rm_index(filename)
             # if filename exist in index file
             if flag:
@@ -216,7 +236,7 @@ def lgit_status():
         # update index file
         fd = os.open('.lgit/index', os.O_WRONLY)
         os.lseek(fd, 0, 0)
-        content, hash_value = get_hash(name)
+        hash_value = get_hash(name)
         tim = datetime.datetime.fromtimestamp(time.time())
         tstamp = tim.strftime("%Y%m%d%H%M%S")
 
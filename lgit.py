@@ -1,44 +1,118 @@
 #!/usr/bin/env python3
 
 import sys
+import atexit
 import os
+import struct
+import tempfile
+import shutil
+import zlib
+import mmap
+import re
+import heapq
+import bisect
+import collections
+import socket
+import select
+import ctypes
+import ctypes.util
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import configparser
+import contextlib
+import threading
+import io
+import json
+import concurrent.futures
+import functools
 import hashlib
 import time
 import datetime
 import calendar
+try:
+    import blake3
+except ImportError:
+    blake3 = None
 
 '''
 lgit init:            initialises version control in the current
                       directory (until this has
-                      been done, any lgit command should return a fatal error)
+                      been done, any lgit command should return a fatal error);
+                      --hash sha1|blake2b|blake3 chooses how objects are
+                      named (blake3 needs the blake3 module)
 lgit add:             stages changes, should work with files and recursively
                       with directories
 lgit rm:              removes a file from the working directory and the index
 lgit config --author: sets a user for authoring the commits
+lgit config <key> <value>:
+                      sets an option, e.g. core.compression (-1..9, 0
+                      stores files uncompressed so checkout copies them in
+                      the kernel), core.checkoutlinks (true hard links
+                      those read-only objects into the working
+                      directory), core.objectcachesize (bytes of objects
+                      kept in memory during a command, default 32 MiB)
+                      or core.chunkthreshold (files bigger than this many
+                      bytes are stored as deduplicated chunks)
 lgit commit -m:       creates a commit with the changes currently
                       staged (if the config file is empty,
                       this should not be possible!)
 lgit status:          updates the index with the content of the working
                       directory and displays the status of
-                      tracked/untracked files
+                      tracked/untracked files; files matching the
+                      gitignore-style patterns of .lgitignore files or
+                      .lgit/info/exclude are neither listed nor added
 lgit ls-files:        lists all the files currently tracked in the index,
-                      relative to the current directory
-lgit log:             shows the commit history
+                      relative to the current directory; with -z each is
+                      followed by a NUL instead of a newline
+lgit add/rm --stdin:  read the paths from stdin, one per line or NUL
+                      terminated with -z
+lgit log [<branch>]:  shows the history of a branch (default: the current
+                      one), newest first; -n <count>, --since <date> and
+                      --author <name> filter it
+lgit merge-base [--is-ancestor] <commit> <commit>:
+                      prints the best common ancestor of two commits or
+                      branches, or tells if the first is an ancestor of
+                      the second through the exit status
+lgit fsmonitor (start | stop | run):
+                      starts, stops or runs in the foreground a daemon
+                      that watches the working directory with inotify, so
+                      commands only check the files that changed
+lgit diff [--cached | <commit> <commit>]:
+                      shows the changes not staged yet, the staged changes
+                      or the changes between two commits or branches
+--trace:              with any command, or LGIT_TRACE=1 in the environment,
+                      writes the timings of its phases and counters of the
+                      files and objects it read and wrote as JSON lines to
+                      stderr; LGIT_TRACE=<absolute path> appends them to a
+                      file instead
+-j <jobs>:            how many files add and status hash and checkout and
+                      stash write at once (default: the number of CPUs)
+lgit.Repository:      used from Python, opens a repository once for many
+                      operations which return results and raise LgitError
+lgit gc / repack:     packs objects into a single pack file, older
+                      versions of a file are stored as deltas
 '''
 
 
-def lgit_init():
+def lgit_init(hash_name='sha1'):
     lst = ['commits', 'objects', 'snapshots']
+    if hash_name not in HASH_ALGORITHMS:
+        raise LgitError('fatal: unknown hash algorithm \'%s\', expected one '
+                        'of %s' % (hash_name, ', '.join(HASH_ALGORITHMS)))
     if not os.path.exists('.lgit'):
         os.mkdir('.lgit')
         # create directories listed in lst
         for i in range(len(lst)):
             os.mkdir('.lgit/' + lst[i])
-        logname_str = os.getenv('LOGNAME')
-        logname_byte = logname_str
-        fd = open('.lgit/config', 'w')
-        fd.write(logname_byte)
-        fd.close()
+        config = configparser.ConfigParser(interpolation=None)
+        config['user'] = {'author': os.getenv('LOGNAME', '')}
+        # sha1 repositories can still be read by older versions of lgit
+        config['core'] = {'hash': hash_name,
+                          'formatversion': '1' if hash_name == 'sha1'
+                          else str(FORMAT_VERSION)}
+        write_config(config)
         fd = open('.lgit/index', 'w')
         fd.close()
 
@@ -54,36 +128,1627 @@ def lgit_init():
         print('Git repository already initialized.')
 
 
+# files are hashed and copied in blocks of this size
+BLOCK_SIZE = 1024 * 1024
+# the ioctl sharing the blocks of a file with another on btrfs or xfs
+FICLONE = 0x40049409
+# objects are named after the digest of the algorithm chosen by `lgit init
+# --hash` and saved as core.hash. Repositories not using sha1 have
+# core.formatversion 2, which versions of lgit that only know sha1 refuse
+HASH_ALGORITHMS = {
+    'sha1': hashlib.sha1,
+    'blake2b': lambda: hashlib.blake2b(digest_size=32),
+}
+if blake3 is not None:
+    HASH_ALGORITHMS['blake3'] = blake3.blake3
+FORMAT_VERSION = 2
+# objects start with a signature, their type and the size of their content,
+# followed by the zlib compressed content
+OBJECT_SIGNATURE = b'LOBJ'
+OBJECT_HEADER = struct.Struct('>4sBQ')
+OBJ_BLOB = 1
+# a big file stored in chunks is a manifest listing "<chunk hash> <size>"
+OBJ_MANIFEST = 2
+# a tree lists the "blob <hash> <name>" files and "tree <hash> <name>"
+# subdirectories of a directory sorted by name, so unchanged directories
+# keep the same tree from commit to commit
+OBJ_TREE = 3
+# sizes of the chunks of files bigger than core.chunkthreshold
+CHUNK_MIN = 64 * 1024
+CHUNK_AVG = 256 * 1024
+CHUNK_MAX = 1024 * 1024
+CHUNK_WINDOW = 64
+CHUNK_MASK_SMALL = (1 << 16) - 1
+CHUNK_MASK_LARGE = (1 << 11) - 1
+# packs hold many objects each stored as a PACK_ENTRY header (type, size
+# of the content, size of the compressed data), the binary name of the
+# base object for deltas, then the zlib compressed content or delta. Their
+# .idx has a fan-out table of counts per first byte, the sorted names and
+# the offsets of the entries in the pack
+PACK_SIGNATURE = b'LPCK'
+PACK_INDEX_SIGNATURE = b'LPIX'
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct('>4sII')
+PACK_ENTRY = struct.Struct('>BQQ')
+PACK_DELTA = 0x80
+# a delta is the sizes of its base and of its result followed by copy
+# (offset and length in base) and insert (length then bytes) operations
+DELTA_HEADER = struct.Struct('>QQ')
+DELTA_COPY = struct.Struct('>BQI')
+DELTA_INSERT = struct.Struct('>BI')
+DELTA_OP_COPY = 0
+DELTA_OP_INSERT = 1
+DELTA_MIN_COPY = 8
+MAX_DELTA_DEPTH = 10
+# bytes of object content kept in memory by default (core.objectcachesize),
+# so objects read again during a command, like the same file at many
+# paths, subtrees or the bases of deltas along a chain, are read once
+OBJECT_CACHE_SIZE = 32 * 1024 * 1024
+# objects bigger than this are never packed
+BIG_FILE_THRESHOLD = 32 * 1024 * 1024
+
+# commands changing the index, HEAD or a branch take the lock <file>.lock
+# and wait at most LOCK_TIMEOUT seconds for another lgit to release it
+LOCK_TIMEOUT = 10
+held_locks = set()
+# commands which never change the index, so they do not refresh it or take
+# its lock; gc does, as it deletes objects and packs others may be reading
+READ_ONLY_COMMANDS = ['ls-files', 'config', 'log', 'merge-base', 'branch',
+                      'fsmonitor']
+
+# lgit diff shows this many lines around changes; files bigger than
+# DIFF_MAX_SIZE or with a NUL byte in their first DIFF_BINARY_CHECK bytes
+# are only said to differ, and line ranges needing more than DIFF_MAX_COST
+# edits are shown as replaced
+DIFF_CONTEXT = 3
+DIFF_MAX_SIZE = 256 * 1024 * 1024
+DIFF_BINARY_CHECK = 8000
+DIFF_MAX_COST = 2000
+
+
+class LgitError(Exception):
+    '''A failed lgit command, its message is what the command line prints.'''
+
+
+class CheckoutConflict(LgitError):
+    '''Checkout would overwrite the local changes of paths.'''
+
+    def __init__(self, paths):
+        LgitError.__init__(self, 'error: Your local changes to the '
+                           'following files would be overwritten by '
+                           'checkout:\n\t' + '\n\t'.join(paths))
+        self.paths = paths
+
+
+# LGIT_TRACE=1 or --trace writes to stderr, and LGIT_TRACE=<absolute path>
+# appends to a file, a JSON line per traced phase then one for the whole
+# command, with counters of the work done. Tracing is off when trace_file
+# is None and phases then cost a function call returning NO_TRACE
+trace_file = None
+trace_command = None
+trace_start = 0
+trace_counters = collections.Counter()
+trace_phases = []
+trace_lock = threading.Lock()
+NO_TRACE = contextlib.nullcontext()
+
+# .lgit/config is parsed once per invocation
+cached_config = None
+# the hash algorithm of the repository and the size of its digests
+cached_hash = None
+# packs are mapped in memory once per invocation, or again when the mtime
+# of their directory shows a gc replaced them
+cached_packs = None
+cached_packs_mtime = None
+# {hash: (type, content)} of the objects read last, oldest first, with
+# the hits, misses and evictions of the cache for tuning its size; objects
+# bigger than a quarter of it are not kept
+object_cache = collections.OrderedDict()
+object_cache_size = 0
+object_cache_limit = None
+object_cache_stats = collections.Counter()
+object_cache_lock = threading.Lock()
+# .lgit/log lets `lgit log` run without opening commit files: index holds
+# a LOG_RECORD (commit name, timestamp, author id, offset and length of the
+# message in messages) per commit, authors has one author per line
+LOG_RECORD = struct.Struct('>21sqIQI')
+# .lgit/commit-graph has a GRAPH_RECORD (commit name, generation, positions
+# of up to two parents or -1) per commit in commit order, so ancestry is
+# walked without reading commit files. A commit's generation is higher
+# than its parents', which lets walks stop early
+GRAPH_RECORD = struct.Struct('>21sIii')
+# the fsmonitor daemon answers on this socket which paths changed since a
+# token "<daemon id>:<event number>" given by a previous answer
+FSMONITOR_SOCKET = '.lgit/fsmonitor.sock'
+FSMONITOR_TIMEOUT = 2
+# struct inotify_event and the flags of <sys/inotify.h> used by fsmonitor
+INOTIFY_EVENT = struct.Struct('iIII')
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+                IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+
+def read_config():
+    # get .lgit/config, older repositories only store the author's name in it
+    global cached_config
+    if cached_config is None:
+        cached_config = configparser.ConfigParser(interpolation=None)
+        file = open('.lgit/config', 'r')
+        content = file.read()
+        file.close()
+        try:
+            cached_config.read_string(content)
+        except configparser.MissingSectionHeaderError:
+            cached_config['user'] = {'author': content.strip('\n')}
+    return cached_config
+
+
+def write_config(config):
+    global cached_config
+    file = io.StringIO()
+    config.write(file)
+    write_file('.lgit/config', file.getvalue().encode())
+    cached_config = config
+
+
+def get_config(name, default=None):
+    # name is "section.key", e.g. "user.author"
+    section, key = name.split('.', 1)
+    return read_config().get(section, key, fallback=default)
+
+
+def lock_file(path, wait=True):
+    # take the lock of path; without wait, only return whether it is free
+    lock_path = path + '.lock'
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    delay = 0.001
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            held_locks.add(path)
+            return True
+        except FileExistsError:
+            if not wait:
+                return False
+            if time.monotonic() > deadline:
+                raise LgitError(
+                    'fatal: Unable to create \'%s\': File exists.\n\n'
+                    'Another lgit process seems to be running in this '
+                    'repository.\nIf it died, remove the file manually '
+                    'to continue.' % lock_path)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+
+def unlock_file(path):
+    held_locks.discard(path)
+    os.remove(path + '.lock')
+
+
+@atexit.register
+def unlock_files():
+    # locks are also released when a command fails
+    for path in list(held_locks):
+        unlock_file(path)
+
+
+def write_file(path, content):
+    # write to a temporary file renamed over path once it is on disk, so
+    # neither readers nor a crash ever see a half written file
+    fd, tmp_path = tempfile.mkstemp(prefix='tmp_', dir='.lgit')
+    try:
+        file = os.fdopen(fd, 'wb')
+        file.write(content)
+        file.flush()
+        os.fsync(fd)
+        trace_count('bytes_written', len(content))
+        file.close()
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def start_trace(command, value):
+    # value is LGIT_TRACE or '1' for --trace
+    global trace_file, trace_command, trace_start
+    if value in ['', '0', 'false']:
+        return
+    if os.path.isabs(value):
+        trace_file = open(value, 'a')
+    else:
+        trace_file = sys.stderr
+    trace_command = command
+    trace_start = time.perf_counter()
+    atexit.register(finish_trace)
+
+
+def finish_trace():
+    write_trace({'event': 'command', 'command': trace_command,
+                 'pid': os.getpid(),
+                 'duration': time.perf_counter() - trace_start,
+                 'counters': dict(trace_counters)})
+    trace_file.flush()
+
+
+def write_trace(record):
+    with trace_lock:
+        trace_file.write(json.dumps(record) + '\n')
+
+
+def trace_count(name, value=1):
+    if trace_file is not None:
+        with trace_lock:
+            trace_counters[name] += value
+
+
+def trace_phase(name):
+    # use as "with trace_phase(name):" around a phase of a command
+    if trace_file is None:
+        return NO_TRACE
+    return traced_phase(name)
+
+
+@contextlib.contextmanager
+def traced_phase(name):
+    trace_phases.append(name)
+    counters = dict(trace_counters)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        write_trace({
+            'event': 'phase', 'command': trace_command,
+            'phase': '/'.join(trace_phases),
+            'start': start - trace_start,
+            'duration': time.perf_counter() - start,
+            'counters': {key: value - counters.get(key, 0)
+                         for key, value in trace_counters.items()
+                         if value != counters.get(key, 0)}})
+        trace_phases.pop()
+
+
+def get_hash_algorithm():
+    # get (function returning a new hash object, digest size) as set up by
+    # `lgit init --hash`
+    global cached_hash
+    if cached_hash is None:
+        version = get_config('core.formatversion', '1')
+        if not version.isdigit() or int(version) > FORMAT_VERSION:
+            raise LgitError('fatal: unknown repository format version %s'
+                            % version)
+        name = get_config('core.hash', 'sha1')
+        if name not in HASH_ALGORITHMS:
+            raise LgitError('fatal: unknown hash algorithm \'%s\'%s' % (
+                name, ' (the blake3 module is not installed)'
+                if name == 'blake3' else ''))
+        new = HASH_ALGORITHMS[name]
+        cached_hash = (new, new().digest_size)
+    return cached_hash
+
+
+def new_hash(data=b''):
+    hasher = get_hash_algorithm()[0]()
+    hasher.update(data)
+    return hasher
+
+
+def get_digest_size():
+    return get_hash_algorithm()[1]
+
+
 def get_hash(filename):
-    # get content and sha1 value of file
-    fd = open(filename, 'r')
+    # get the hash value of file, read block by block as bytes
+    hasher = new_hash()
+    size = 0
+    file = open(filename, 'rb')
+    block = file.read(BLOCK_SIZE)
+    while block:
+        hasher.update(block)
+        size += len(block)
+        block = file.read(BLOCK_SIZE)
+    file.close()
+    trace_count('files_hashed')
+    trace_count('bytes_read', size)
+    return hasher.hexdigest()
+
+
+def get_object_path(hash_value):
+    return '.lgit/objects/%s/%s' % (hash_value[:2], hash_value[2:])
+
+
+def get_compression_level():
+    value = get_config('core.compression', str(zlib.Z_DEFAULT_COMPRESSION))
     try:
-        content = fd.read().encode()
-    except UnicodeError:
-        return None, None
-    return content.decode(), hashlib.sha1(content).hexdigest()
+        level = int(value)
+    except ValueError:
+        level = None
+    if level is None or not -1 <= level <= 9:
+        raise LgitError('fatal: bad core.compression value \'%s\', '
+                        'expected -1..9' % value)
+    return level
+
+
+def is_raw_content(block, level):
+    # with core.compression 0 blobs are stored as is, without a header, like
+    # the objects of older versions of lgit, so they can be copied or linked
+    # into the working directory; content starting like a header cannot be
+    return level == 0 and not block.startswith(OBJECT_SIGNATURE)
+
+
+def store_file(filename):
+    # hash filename and compress it into the object store in a single pass,
+    # the object is renamed to its path once the hash is known; the hash is
+    # the one of the uncompressed content
+    threshold = get_config('core.chunkthreshold')
+    if threshold and os.stat(filename).st_size > int(threshold):
+        return store_chunked_file(filename)
+    hasher = new_hash()
+    level = get_compression_level()
+    fd, tmp_path = tempfile.mkstemp(prefix='tmp_obj_', dir='.lgit/objects')
+    tmp_file = os.fdopen(fd, 'wb')
+    size = 0
+    file = open(filename, 'rb')
+    block = file.read(BLOCK_SIZE)
+    compressor = None
+    if not is_raw_content(block, level):
+        compressor = zlib.compressobj(level)
+        # the size in the header is only known at the end
+        tmp_file.write(OBJECT_HEADER.pack(OBJECT_SIGNATURE, OBJ_BLOB, 0))
+    while block:
+        hasher.update(block)
+        size += len(block)
+        tmp_file.write(compressor.compress(block) if compressor else block)
+        block = file.read(BLOCK_SIZE)
+    file.close()
+    if compressor is None:
+        written = tmp_file.tell()
+        os.fchmod(tmp_file.fileno(), 0o444)
+    else:
+        tmp_file.write(compressor.flush())
+        written = tmp_file.tell()
+        tmp_file.seek(0)
+        tmp_file.write(OBJECT_HEADER.pack(OBJECT_SIGNATURE, OBJ_BLOB, size))
+    tmp_file.close()
+
+    hash_value = hasher.hexdigest()
+    trace_count('files_hashed')
+    trace_count('bytes_read', size)
+    trace_count('bytes_written', written)
+    if trace_file is not None:
+        trace_count('objects_reused' if has_object(hash_value)
+                    else 'objects_created')
+    move_object(tmp_path, hash_value)
+    return hash_value
+
+
+def move_object(tmp_path, hash_value):
+    # rename a written object to its path; gc removes the fan-out
+    # directories it empties, so one may go away before the rename
+    path = get_object_path(hash_value)
+    while True:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.replace(tmp_path, path)
+            return
+        except FileNotFoundError:
+            if not os.path.exists(tmp_path):
+                raise
+
+
+def has_object(hash_value):
+    if (os.path.exists(get_object_path(hash_value)) or
+            find_packed_object(hash_value)[0] is not None):
+        return True
+    # a gc since the packs were mapped may have packed the object
+    return reload_packs() and find_packed_object(hash_value)[0] is not None
+
+
+def write_object(content, obj_type, hash_value):
+    # store content under the name hash_value unless it is already there
+    if has_object(hash_value):
+        trace_count('objects_reused')
+        return
+    level = get_compression_level()
+    fd, tmp_path = tempfile.mkstemp(prefix='tmp_obj_', dir='.lgit/objects')
+    tmp_file = os.fdopen(fd, 'wb')
+    if obj_type == OBJ_BLOB and is_raw_content(content, level):
+        tmp_file.write(content)
+        os.fchmod(fd, 0o444)
+    else:
+        tmp_file.write(OBJECT_HEADER.pack(OBJECT_SIGNATURE, obj_type,
+                                          len(content)))
+        tmp_file.write(zlib.compress(content, level))
+    trace_count('objects_created')
+    trace_count('bytes_written', tmp_file.tell())
+    tmp_file.close()
+    move_object(tmp_path, hash_value)
+
+
+def find_chunk_end(buffer):
+    # get the size of the first chunk in buffer, or None if more data is
+    # needed to tell. Chunks end after a line end whose preceding
+    # CHUNK_WINDOW bytes hash to a value with the mask bits clear, so the
+    # boundaries move with the content and an edit only changes the chunks
+    # around it. Only line ends are tried, which keeps the rolling hash
+    # affordable in Python; the mask is looser past CHUNK_AVG to keep chunk
+    # sizes close to it
+    position = buffer.find(b'\n', CHUNK_MIN - 1)
+    while position != -1 and position < CHUNK_MAX:
+        end = position + 1
+        mask = CHUNK_MASK_SMALL if end < CHUNK_AVG else CHUNK_MASK_LARGE
+        if zlib.crc32(buffer[end - CHUNK_WINDOW:end]) & mask == 0:
+            return end
+        position = buffer.find(b'\n', end)
+    if len(buffer) >= CHUNK_MAX:
+        return CHUNK_MAX
+    return None
+
+
+def iter_file_chunks(file):
+    # yield the content-defined chunks of a file opened in binary mode
+    buffer = b''
+    block = file.read(BLOCK_SIZE)
+    while block:
+        buffer += block
+        end = find_chunk_end(buffer)
+        while end:
+            yield buffer[:end]
+            buffer = buffer[end:]
+            end = find_chunk_end(buffer)
+        block = file.read(BLOCK_SIZE)
+    if buffer:
+        yield buffer
+
+
+def store_chunked_file(filename):
+    # store a big file as chunks plus a manifest listing them, named after
+    # the hash of the whole file; chunks already stored are not written
+    hasher = new_hash()
+    manifest = []
+    trace_count('files_hashed')
+    file = open(filename, 'rb')
+    for chunk in iter_file_chunks(file):
+        hasher.update(chunk)
+        trace_count('bytes_read', len(chunk))
+        chunk_hash = new_hash(chunk).hexdigest()
+        write_object(chunk, OBJ_BLOB, chunk_hash)
+        manifest.append('%s %d\n' % (chunk_hash, len(chunk)))
+    file.close()
+    hash_value = hasher.hexdigest()
+    write_object(''.join(manifest).encode(), OBJ_MANIFEST, hash_value)
+    return hash_value
 
 
-def get_files(dir_name):
-    # get all files from dir_name
-    result = []
-    scan = os.scandir(dir_name)
-    subs = []
-    for elem in scan:
-        subs.append(elem.name)
-    for sub in subs:
-        if dir_name != '.':
-            path = dir_name + '/' + sub
+def iter_manifest(manifest):
+    # yield the content of the chunks listed in a manifest
+    for line in manifest.decode().splitlines():
+        yield from iter_object(line.split(' ')[0])
+
+
+def get_object_cache_limit():
+    global object_cache_limit
+    if object_cache_limit is None:
+        value = get_config('core.objectcachesize', str(OBJECT_CACHE_SIZE))
+        try:
+            object_cache_limit = int(value)
+        except ValueError:
+            raise LgitError('fatal: bad core.objectcachesize value \'%s\''
+                            % value)
+    return object_cache_limit
+
+
+def lookup_object(hash_value):
+    # get (type, content) of an object from object_cache, None if it is not
+    # there
+    with object_cache_lock:
+        obj = object_cache.get(hash_value)
+        if obj is not None:
+            object_cache.move_to_end(hash_value)
+        name = 'object_cache_misses' if obj is None else 'object_cache_hits'
+        object_cache_stats[name] += 1
+    trace_count(name)
+    return obj
+
+
+def cache_object(hash_value, obj):
+    # keep obj in object_cache, evicting the least recently used objects
+    global object_cache_size
+    limit = get_object_cache_limit()
+    if len(obj[1]) > limit // 4:
+        return
+    evicted = 0
+    with object_cache_lock:
+        if hash_value in object_cache:
+            return
+        object_cache[hash_value] = obj
+        object_cache_size += len(obj[1])
+        while object_cache_size > limit:
+            object_cache_size -= len(object_cache.popitem(last=False)[1][1])
+            evicted += 1
+        object_cache_stats['object_cache_evictions'] += evicted
+    if evicted:
+        trace_count('object_cache_evictions', evicted)
+
+
+def parse_loose_object(content):
+    # get (type, content) of the data of a loose object file
+    if not content.startswith(OBJECT_SIGNATURE):
+        return OBJ_BLOB, content
+    signature, obj_type, size = OBJECT_HEADER.unpack_from(content)
+    return obj_type, zlib.decompress(content[OBJECT_HEADER.size:])
+
+
+def read_object(hash_value):
+    # get the type and the whole content of a loose or packed object,
+    # through object_cache
+    obj = lookup_object(hash_value)
+    if obj is not None:
+        return obj
+    return load_object(hash_value)
+
+
+def load_object(hash_value):
+    # read a whole object from its file or pack and keep it in object_cache,
+    # for callers which already missed it there
+    trace_count('objects_read')
+    for retry in [False, True]:
+        # a gc since the packs were mapped may have packed the loose object
+        # or replaced the packs
+        if retry and not reload_packs():
+            break
+        try:
+            file = open(get_object_path(hash_value), 'rb')
+        except FileNotFoundError:
+            pack, offset = find_packed_object(hash_value)
+            if pack is None:
+                continue
+            obj = read_packed_object(pack, offset)
+        else:
+            obj = parse_loose_object(file.read())
+            file.close()
+        cache_object(hash_value, obj)
+        return obj
+    raise LgitError('fatal: object %s not found' % hash_value)
+
+
+def iter_content(obj):
+    # yield the content of an object read whole block by block
+    obj_type, content = obj
+    if obj_type == OBJ_MANIFEST:
+        yield from iter_manifest(content)
+        return
+    for i in range(0, len(content), BLOCK_SIZE):
+        yield content[i:i + BLOCK_SIZE]
+
+
+def iter_object(hash_value):
+    # yield the content of an object block by block, from object_cache when
+    # it is there and from its file otherwise
+    obj = lookup_object(hash_value)
+    if obj is not None:
+        yield from iter_content(obj)
+        return
+    yield from iter_stored_object(hash_value)
+
+
+def iter_stored_object(hash_value):
+    # yield the content of an object missed in object_cache; objects written
+    # by older versions of lgit have no header and are not compressed.
+    # Objects small enough for object_cache are read whole and kept there,
+    # others are streamed
+    try:
+        file = open(get_object_path(hash_value), 'rb')
+    except FileNotFoundError:
+        # packed objects are small enough to be read at once
+        yield from iter_content(load_object(hash_value))
+        return
+    header = file.read(OBJECT_HEADER.size)
+    if header.startswith(OBJECT_SIGNATURE):
+        size = OBJECT_HEADER.unpack(header)[2]
+    else:
+        size = os.fstat(file.fileno()).st_size
+    if size <= get_object_cache_limit() // 4:
+        trace_count('objects_read')
+        obj = parse_loose_object(header + file.read())
+        file.close()
+        cache_object(hash_value, obj)
+        yield from iter_content(obj)
+        return
+    if not header.startswith(OBJECT_SIGNATURE):
+        block = header
+        while block:
+            yield block
+            block = file.read(BLOCK_SIZE)
+        file.close()
+        return
+    if OBJECT_HEADER.unpack(header)[1] == OBJ_MANIFEST:
+        manifest = zlib.decompress(file.read())
+        file.close()
+        yield from iter_manifest(manifest)
+        return
+
+    decompressor = zlib.decompressobj()
+    while not decompressor.eof:
+        # never inflate more than a block at once
+        block = decompressor.unconsumed_tail or file.read(BLOCK_SIZE)
+        data = decompressor.decompress(block, BLOCK_SIZE)
+        if not block and not data:
+            file.close()
+            raise LgitError('fatal: object %s is corrupt' % hash_value)
+        yield data
+    file.close()
+
+
+def get_raw_object_files(hash_value):
+    # get the paths of the uncompressed loose objects whose content makes
+    # the one of an object, in order, or None if it has to be inflated
+    path = get_object_path(hash_value)
+    try:
+        file = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    header = file.read(OBJECT_HEADER.size)
+    if not header.startswith(OBJECT_SIGNATURE):
+        file.close()
+        return [path]
+    if OBJECT_HEADER.unpack(header)[1] != OBJ_MANIFEST:
+        file.close()
+        return None
+    manifest = zlib.decompress(file.read())
+    file.close()
+    paths = []
+    for line in manifest.decode().splitlines():
+        chunk_paths = get_raw_object_files(line.split(' ')[0])
+        if chunk_paths is None:
+            return None
+        paths += chunk_paths
+    return paths
+
+
+def copy_file_data(source, target):
+    # append the content of the file source to the file target without
+    # reading it into python: a reflink when it is the whole file and the
+    # filesystem shares blocks, else copy_file_range or sendfile
+    size = os.fstat(source).st_size
+    if fcntl is not None and not os.lseek(target, 0, os.SEEK_CUR):
+        try:
+            fcntl.ioctl(target, FICLONE, source)
+            os.lseek(target, size, os.SEEK_SET)
+            return
+        except OSError:
+            pass
+    offset = 0
+    for copy in (getattr(os, 'copy_file_range', None),
+                 getattr(os, 'sendfile', None)):
+        if copy is None:
+            continue
+        try:
+            while offset < size:
+                if copy is os.sendfile:
+                    copied = os.sendfile(target, source, offset,
+                                         size - offset)
+                else:
+                    copied = os.copy_file_range(source, target,
+                                                size - offset, offset)
+                if not copied:
+                    break
+                offset += copied
+            return
+        except OSError:
+            # not supported between these files, go on with the next way
+            pass
+    while offset < size:
+        block = os.pread(source, BLOCK_SIZE, offset)
+        if not block:
+            break
+        offset += os.write(target, block)
+
+
+def copy_object(hash_value, filename):
+    # write the content of an object to filename: uncompressed loose
+    # objects are copied by the kernel, or hard linked when
+    # core.checkoutlinks is set, others are inflated block by block. The
+    # file is replaced rather than rewritten, it may be a link to an object.
+    # Objects in object_cache are written from memory, their files unread
+    tmp_path = '%s.lgit-%d' % (filename, os.getpid())
+    obj = lookup_object(hash_value)
+    paths = None if obj is not None else get_raw_object_files(hash_value)
+    if (paths is not None and len(paths) == 1 and
+            get_config('core.checkoutlinks', 'false') == 'true'):
+        try:
+            os.link(paths[0], tmp_path)
+            os.replace(tmp_path, filename)
+            trace_count('files_linked')
+            return
+        except OSError:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        if paths is None:
+            if obj is not None:
+                blocks = iter_content(obj)
+            else:
+                blocks = iter_stored_object(hash_value)
+            for block in blocks:
+                os.write(fd, block)
+        else:
+            for path in paths:
+                source = os.open(path, os.O_RDONLY)
+                copy_file_data(source, fd)
+                os.close(source)
+        trace_count('bytes_written', os.lseek(fd, 0, os.SEEK_CUR))
+    except BaseException:
+        os.close(fd)
+        os.remove(tmp_path)
+        raise
+    os.close(fd)
+    os.replace(tmp_path, filename)
+    trace_count('files_written')
+
+
+def build_trees(files):
+    # get {directory: (hash, content)} of the trees of files, {path: hash};
+    # the root directory is ''
+    children = {'': {}}
+    for name, hash_value in files.items():
+        parts = name.split('/')
+        for i in range(1, len(parts)):
+            dir_name = '/'.join(parts[:i])
+            if dir_name not in children:
+                children[dir_name] = {}
+                children['/'.join(parts[:i - 1])][parts[i - 1]] = None
+        children['/'.join(parts[:-1])][parts[-1]] = hash_value
+    # subdirectories are hashed before their parent
+    trees = {}
+    for dir_name in sorted(children, reverse=True,
+                           key=lambda name: name.count('/') + bool(name)):
+        prefix = dir_name + '/' if dir_name else ''
+        lines = []
+        for name, hash_value in sorted(children[dir_name].items()):
+            if hash_value is None:
+                lines.append('tree %s %s\n' % (trees[prefix + name][0], name))
+            else:
+                lines.append('blob %s %s\n' % (hash_value, name))
+        content = ''.join(lines).encode()
+        trees[dir_name] = (new_hash(content).hexdigest(), content)
+    return trees
+
+
+def parse_tree(content):
+    # get the (kind, hash, name) entries of a tree's content
+    return [line.split(' ', 2) for line in content.decode().splitlines()]
+
+
+def read_tree(tree_hash):
+    # get {name: (kind, hash)} of a tree, empty for None
+    if tree_hash is None:
+        return {}
+    return {name: (kind, hash_value) for kind, hash_value, name
+            in parse_tree(read_object(tree_hash)[1])}
+
+
+def write_trees(trees, old_tree, dir_name=''):
+    # store the trees built by build_trees() below dir_name, old_tree is
+    # the tree dir_name had in the parent commit: subtrees it already has
+    # are neither read nor written again
+    hash_value, content = trees[dir_name]
+    if hash_value == old_tree:
+        return hash_value
+    write_object(content, OBJ_TREE, hash_value)
+    old = read_tree(old_tree)
+    prefix = dir_name + '/' if dir_name else ''
+    for kind, subtree, name in parse_tree(content):
+        if kind == 'tree':
+            old_kind, old_hash = old.get(name, (None, None))
+            write_trees(trees, old_hash if old_kind == 'tree' else None,
+                        prefix + name)
+    return hash_value
+
+
+def read_tree_files(tree_hash, cache=None):
+    # get {path: hash} of the files below a tree; cache saves the files of
+    # the trees already read, for callers reading many similar trees
+    if cache is not None and tree_hash in cache:
+        return cache[tree_hash]
+    files = {}
+    for name, (kind, hash_value) in read_tree(tree_hash).items():
+        if kind == 'tree':
+            for path, file_hash in read_tree_files(hash_value, cache).items():
+                files[name + '/' + path] = file_hash
+        else:
+            files[name] = hash_value
+    if cache is not None:
+        cache[tree_hash] = files
+    return files
+
+
+def diff_trees(old_tree, new_tree, prefix=''):
+    # get {path: (old hash, new hash)} of the files which differ between two
+    # trees, None for a missing file; identical subtrees are skipped
+    # without reading them
+    changes = {}
+    if old_tree == new_tree:
+        return changes
+    old = read_tree(old_tree)
+    new = read_tree(new_tree)
+    for name in old.keys() | new.keys():
+        old_kind, old_hash = old.get(name, (None, None))
+        new_kind, new_hash = new.get(name, (None, None))
+        if (old_kind, old_hash) == (new_kind, new_hash):
+            continue
+        if old_kind == 'tree' or new_kind == 'tree':
+            changes.update(diff_trees(
+                old_hash if old_kind == 'tree' else None,
+                new_hash if new_kind == 'tree' else None,
+                prefix + name + '/'))
+        if old_kind == 'blob' or new_kind == 'blob':
+            changes[prefix + name] = (old_hash if old_kind == 'blob' else None,
+                                      new_hash if new_kind == 'blob' else None)
+    return changes
+
+
+def get_loose_objects():
+    # get the names of all loose objects with the size of their content
+    objects = {}
+    for dir_name in os.listdir('.lgit/objects'):
+        if len(dir_name) != 2:
+            continue
+        for name in os.listdir('.lgit/objects/' + dir_name):
+            path = '.lgit/objects/%s/%s' % (dir_name, name)
+            file = open(path, 'rb')
+            header = file.read(OBJECT_HEADER.size)
+            file.close()
+            if header.startswith(OBJECT_SIGNATURE):
+                objects[dir_name + name] = OBJECT_HEADER.unpack(header)[2]
+            else:
+                objects[dir_name + name] = os.stat(path).st_size
+    return objects
+
+
+def get_packs():
+    # map every pack and its index in memory, once per invocation
+    global cached_packs, cached_packs_mtime
+    if cached_packs is None:
+        cached_packs = []
+        cached_packs_mtime = get_packs_mtime()
+        if cached_packs_mtime is not None:
+            for name in sorted(os.listdir('.lgit/objects/pack')):
+                if not name.endswith('.idx'):
+                    continue
+                try:
+                    cached_packs.append(open_pack(
+                        '.lgit/objects/pack/' + name[:-4]))
+                except FileNotFoundError:
+                    # removed by a gc since it was listed
+                    pass
+    return cached_packs
+
+
+def get_packs_mtime():
+    try:
+        return os.stat('.lgit/objects/pack').st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def reload_packs():
+    # map the packs again if a gc changed them since they were mapped,
+    # return whether it did
+    if cached_packs is None or get_packs_mtime() == cached_packs_mtime:
+        return False
+    reset_packs()
+    return True
+
+
+def open_pack(path):
+    pack = {'path': path}
+    for ext in ['idx', 'pack']:
+        file = open('%s.%s' % (path, ext), 'rb')
+        pack[ext] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        file.close()
+    signature, version, count = PACK_HEADER.unpack_from(pack['idx'])
+    if signature != PACK_INDEX_SIGNATURE or version != PACK_VERSION:
+        raise LgitError('fatal: %s.idx is not a pack index' % path)
+    pack['count'] = count
+    pack['hash_size'] = size = get_digest_size()
+    pack['names'] = PACK_HEADER.size + 256 * 4
+    pack['offsets'] = pack['names'] + count * size
+    return pack
+
+
+def find_packed_object(hash_value):
+    # binary search the name in the part of each pack index that the
+    # fan-out table gives for its first byte, return (pack, offset)
+    name = bytes.fromhex(hash_value)
+    for pack in get_packs():
+        idx = pack['idx']
+        lo = 0
+        if name[0]:
+            lo = struct.unpack_from('>I', idx, PACK_HEADER.size +
+                                    (name[0] - 1) * 4)[0]
+        hi = struct.unpack_from('>I', idx, PACK_HEADER.size + name[0] * 4)[0]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = pack['names'] + mid * pack['hash_size']
+            current = idx[start:start + pack['hash_size']]
+            if current < name:
+                lo = mid + 1
+            elif current > name:
+                hi = mid
+            else:
+                return pack, struct.unpack_from(
+                    '>Q', idx, pack['offsets'] + mid * 8)[0]
+    return None, None
+
+
+def read_packed_object(pack, offset):
+    data = pack['pack']
+    obj_type, size, length = PACK_ENTRY.unpack_from(data, offset)
+    offset += PACK_ENTRY.size
+    if obj_type != PACK_DELTA:
+        return obj_type, zlib.decompress(data[offset:offset + length])
+    base = data[offset:offset + pack['hash_size']].hex()
+    offset += pack['hash_size']
+    obj_type, base_content = read_object(base)
+    delta = zlib.decompress(data[offset:offset + length])
+    return obj_type, apply_delta(base_content, delta)
+
+
+def make_delta(base, target):
+    # describe target as line ranges copied from base and inserted bytes;
+    # a copy of a line is only started for lines long enough to be worth it
+    offsets = {}
+    position = 0
+    for line in base.splitlines(True):
+        offsets.setdefault(line, position)
+        position += len(line)
+
+    ops = [DELTA_HEADER.pack(len(base), len(target))]
+    copy_start = copy_end = 0
+    inserted = []
+    for line in target.splitlines(True):
+        if copy_end > copy_start and base.startswith(line, copy_end):
+            copy_end += len(line)
+            continue
+        offset = None
+        if len(line) >= DELTA_MIN_COPY:
+            offset = offsets.get(line)
+        if offset is None:
+            if copy_end > copy_start:
+                ops.append(DELTA_COPY.pack(DELTA_OP_COPY, copy_start,
+                                           copy_end - copy_start))
+                copy_start = copy_end = 0
+            inserted.append(line)
+            continue
+        if copy_end > copy_start:
+            ops.append(DELTA_COPY.pack(DELTA_OP_COPY, copy_start,
+                                       copy_end - copy_start))
+        if inserted:
+            data = b''.join(inserted)
+            ops.append(DELTA_INSERT.pack(DELTA_OP_INSERT, len(data)) + data)
+            inserted = []
+        copy_start = offset
+        copy_end = offset + len(line)
+    if copy_end > copy_start:
+        ops.append(DELTA_COPY.pack(DELTA_OP_COPY, copy_start,
+                                   copy_end - copy_start))
+    if inserted:
+        data = b''.join(inserted)
+        ops.append(DELTA_INSERT.pack(DELTA_OP_INSERT, len(data)) + data)
+    return b''.join(ops)
+
+
+def apply_delta(base, delta):
+    base_size, size = DELTA_HEADER.unpack_from(delta)
+    if base_size != len(base):
+        raise LgitError('fatal: delta does not apply to its base object')
+    parts = []
+    position = DELTA_HEADER.size
+    while position < len(delta):
+        if delta[position] == DELTA_OP_COPY:
+            op, offset, length = DELTA_COPY.unpack_from(delta, position)
+            parts.append(base[offset:offset + length])
+            position += DELTA_COPY.size
+        else:
+            op, length = DELTA_INSERT.unpack_from(delta, position)
+            position += DELTA_INSERT.size
+            parts.append(delta[position:position + length])
+            position += length
+    content = b''.join(parts)
+    if len(content) != size:
+        raise LgitError('fatal: corrupt delta')
+    return content
+
+
+def add_tree_history(history, tree_hash, dir_name, seen):
+    # add the trees of the directories below tree_hash to history, under
+    # their path and a "/"; subtrees already seen are not read again
+    versions = history.setdefault(dir_name + '/', [])
+    if not versions or versions[-1] != tree_hash:
+        versions.append(tree_hash)
+    if tree_hash in seen:
+        return
+    seen.add(tree_hash)
+    prefix = dir_name + '/' if dir_name else ''
+    for name, (kind, hash_value) in read_tree(tree_hash).items():
+        if kind == 'tree':
+            add_tree_history(history, hash_value, prefix + name, seen)
+
+
+def get_path_history():
+    # get every version each path and each directory's tree had in the
+    # commits, oldest first
+    history = {}
+    cache = {}
+    seen = set()
+    for commit_name in sorted(os.listdir('.lgit/commits')):
+        for name, hash_value in read_commit_files(commit_name, cache).items():
+            versions = history.setdefault(name, [])
+            if not versions or versions[-1] != hash_value:
+                versions.append(hash_value)
+        tree = read_commit_trailer(commit_name)[1]
+        if tree is not None:
+            add_tree_history(history, tree, '', seen)
+    return history
+
+
+def choose_delta_bases(objects):
+    # the newest version of a path or a directory is stored whole and each
+    # older one as a delta against the next newer one, up to
+    # MAX_DELTA_DEPTH deltas: a version is a whole checkpoint again after
+    # that many, so reading any of them applies at most that many deltas
+    bases = {}
+    depths = {}
+    for versions in get_path_history().values():
+        newer = None
+        for hash_value in reversed(versions):
+            if hash_value not in objects:
+                newer = None
+                continue
+            if hash_value not in depths:
+                if newer is not None and depths[newer] < MAX_DELTA_DEPTH:
+                    bases[hash_value] = newer
+                    depths[hash_value] = depths[newer] + 1
+                else:
+                    depths[hash_value] = 0
+            newer = hash_value
+    return bases
+
+
+def convert_snapshots():
+    # replace the snapshots listing every file, written by older versions
+    # of lgit, with the tree of their files, which shares the unchanged
+    # directories with the other snapshots
+    for snapshot_id in sorted(os.listdir('.lgit/snapshots')):
+        path = '.lgit/snapshots/' + snapshot_id
+        file = open(path, 'r')
+        first = file.readline()
+        file.close()
+        if first.startswith('tree '):
+            continue
+        tree = write_trees(build_trees(read_snapshot(snapshot_id)), None)
+        write_file(path, ('tree %s\n' % tree).encode())
+
+
+def pack_objects():
+    # pack every loose or packed object into a single pack, except objects
+    # bigger than core.bigfilethreshold that stay loose to be streamed;
+    # old snapshots are converted to trees first so those are packed too.
+    # Return {'objects': count, 'deltas': count, 'pack': name or None}
+    convert_snapshots()
+    threshold = int(get_config('core.bigfilethreshold', BIG_FILE_THRESHOLD))
+    loose = get_loose_objects()
+    objects = set(name for name, size in loose.items() if size <= threshold)
+    old_packs = get_packs()
+    for pack in old_packs:
+        idx = pack['idx']
+        size = pack['hash_size']
+        for i in range(pack['count']):
+            start = pack['names'] + i * size
+            objects.add(idx[start:start + size].hex())
+    if not objects:
+        return {'objects': 0, 'deltas': 0, 'pack': None}
+    bases = choose_delta_bases(objects)
+
+    names = sorted(objects)
+    level = get_compression_level()
+    os.makedirs('.lgit/objects/pack', exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='tmp_pack_',
+                                    dir='.lgit/objects/pack')
+    pack_file = os.fdopen(fd, 'wb')
+    checksum = hashlib.sha1()
+    header = PACK_HEADER.pack(PACK_SIGNATURE, PACK_VERSION, len(names))
+    pack_file.write(header)
+    checksum.update(header)
+    offsets = {}
+    position = len(header)
+    deltas = 0
+    for hash_value in names:
+        obj_type, content = read_object(hash_value)
+        base = b''
+        if hash_value in bases:
+            delta = make_delta(read_object(bases[hash_value])[1], content)
+            # a delta is only kept when it is much smaller than the object
+            if len(delta) < len(content) // 2:
+                obj_type = PACK_DELTA
+                content = delta
+                base = bytes.fromhex(bases[hash_value])
+                deltas += 1
+        data = zlib.compress(content, level)
+        entry = PACK_ENTRY.pack(obj_type, len(content), len(data)) + base
+        pack_file.write(entry)
+        pack_file.write(data)
+        checksum.update(entry)
+        checksum.update(data)
+        offsets[hash_value] = position
+        position += len(entry) + len(data)
+    pack_file.write(checksum.digest())
+    pack_file.close()
+
+    # the pack is named after the objects it holds
+    pack_name = hashlib.sha1(''.join(names).encode()).hexdigest()
+    pack_path = '.lgit/objects/pack/pack-' + pack_name
+    fanout = [0] * 256
+    for hash_value in names:
+        fanout[int(hash_value[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+    idx = b''.join([PACK_HEADER.pack(PACK_INDEX_SIGNATURE, PACK_VERSION,
+                                     len(names)),
+                    struct.pack('>256I', *fanout)] +
+                   [bytes.fromhex(hash_value) for hash_value in names] +
+                   [struct.pack('>Q', offsets[hash_value])
+                    for hash_value in names])
+    idx_file = open(pack_path + '.idx.tmp', 'wb')
+    idx_file.write(idx + hashlib.sha1(idx).digest())
+    idx_file.close()
+    os.replace(tmp_path, pack_path + '.pack')
+    os.replace(pack_path + '.idx.tmp', pack_path + '.idx')
+
+    # everything is in the new pack now
+    for pack in old_packs:
+        pack['idx'].close()
+        pack['pack'].close()
+        if pack['path'] != pack_path:
+            os.remove(pack['path'] + '.idx')
+            os.remove(pack['path'] + '.pack')
+    reset_packs()
+    for hash_value in objects:
+        if hash_value in loose:
+            os.remove(get_object_path(hash_value))
+    for dir_name in os.listdir('.lgit/objects'):
+        if len(dir_name) == 2 and not os.listdir('.lgit/objects/' + dir_name):
+            os.rmdir('.lgit/objects/' + dir_name)
+    return {'objects': len(names), 'deltas': deltas, 'pack': pack_name}
+
+
+def lgit_gc(repo):
+    packed = repo.gc()
+    if packed['pack'] is None:
+        print('Nothing to pack')
+    else:
+        print('Packed %(objects)d objects (%(deltas)d deltas) into '
+              'pack-%(pack)s.pack' % packed)
+
+
+def reset_packs():
+    global cached_packs, object_cache_size, object_cache_limit
+    cached_packs = None
+    with object_cache_lock:
+        object_cache.clear()
+        object_cache_size = 0
+        object_cache_limit = None
+
+
+def read_untracked_cache():
+    # get {directory: [mtime, file names, subdirectory names]} as saved by
+    # the last walk of the working directory
+    try:
+        file = open('.lgit/untracked-cache', 'r')
+    except FileNotFoundError:
+        return {}
+    cache = json.load(file)
+    file.close()
+    if cache.get('version') != UNTRACKED_CACHE_VERSION:
+        return {}
+    return cache['dirs']
+
+
+def write_untracked_cache(cache):
+    # directories modified this close to the write may change again within
+    # the same timestamp: they are saved as unknown to be listed next time
+    limit = time.time_ns() - RACY_WINDOW
+    dirs = {}
+    for dir_name, (mtime, files, subdirs) in cache.items():
+        dirs[dir_name] = [mtime if mtime < limit else -1, files, subdirs]
+    write_file('.lgit/untracked-cache', json.dumps(
+        {'version': UNTRACKED_CACHE_VERSION, 'dirs': dirs}).encode())
+
+
+def list_dir(dir_name, cache):
+    # get the files and subdirectories of dir_name, only listing it when
+    # its mtime changed since the cached listing; return also whether the
+    # cache was updated
+    mtime = os.stat(dir_name).st_mtime_ns
+    trace_count('dirs_stated')
+    cached = cache.get(dir_name)
+    if cached and cached[0] == mtime:
+        return cached[1], cached[2], False
+    trace_count('dirs_listed')
+    files = []
+    subdirs = []
+    for elem in os.scandir(dir_name):
+        if dir_name == '.' and elem.name == '.lgit':
+            continue
+        if elem.is_dir():
+            subdirs.append(elem.name)
+        elif elem.is_file():
+            files.append(elem.name)
+    cache[dir_name] = [mtime, files, subdirs]
+    return files, subdirs, True
+
+
+def translate_ignore_pattern(pattern):
+    # get a regular expression matching what pattern matches, for paths
+    # relative to the directory of its ignore file
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('**/', i) and (i == 0 or pattern[i - 1] == '/'):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('/**', i) and i + 3 == len(pattern):
+            regex += '/.*'
+            i += 3
+            continue
+        if char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars[0] == '!':
+                chars = '^' + chars[1:]
+            regex += '[%s]' % chars.replace('\\', '\\\\')
+            i = end
+        elif char == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
         else:
-            path = sub
-        if os.path.isfile(path):
-            result.append(path)
+            regex += re.escape(char)
+        i += 1
+    if not anchored:
+        regex = '(?:.*/)?' + regex
+    return regex
+
+
+def compile_ignore_file(filename, base):
+    # get the rules of an ignore file as (base, regex for files, negated
+    # flags, regex for directories, negated flags); the patterns are joined
+    # last first, so the group of a match is the last matching pattern
+    try:
+        file = open(filename, 'r')
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    lines = file.read().splitlines()
+    file.close()
+    file_parts, file_negated = [], []
+    dir_parts, dir_negated = [], []
+    for line in reversed(lines):
+        if not line.endswith('\\ '):
+            line = line.rstrip()
+        if not line or line.startswith('#'):
+            continue
+        negated = line.startswith('!')
+        if negated:
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            continue
+        regex = '(%s)' % translate_ignore_pattern(line)
+        dir_parts.append(regex)
+        dir_negated.append(negated)
+        if not dir_only:
+            file_parts.append(regex)
+            file_negated.append(negated)
+    if not dir_parts:
+        return None
+    file_regex = None
+    if file_parts:
+        file_regex = re.compile('|'.join(file_parts), re.DOTALL)
+    dir_regex = re.compile('|'.join(dir_parts), re.DOTALL)
+    return base, file_regex, file_negated, dir_regex, dir_negated
+
+
+def get_ignore_rules(dir_name):
+    # get the rules applying to the entries of dir_name: .lgit/info/exclude
+    # then the .lgitignore of every directory above it, deepest last
+    rules = []
+    for filename, base in [('.lgit/info/exclude', ''),
+                           ('.lgitignore', '')]:
+        compiled = compile_ignore_file(filename, base)
+        if compiled:
+            rules.append(compiled)
+    if dir_name != '.':
+        parts = dir_name.split('/')
+        for i in range(1, len(parts) + 1):
+            base = '/'.join(parts[:i]) + '/'
+            compiled = compile_ignore_file(base + '.lgitignore', base)
+            if compiled:
+                rules.append(compiled)
+    return rules
+
+
+def is_ignored(rules, path, is_dir):
+    # the deepest ignore file with a matching pattern decides
+    for base, file_regex, file_negated, dir_regex, dir_negated in \
+            reversed(rules):
+        if is_dir:
+            match = dir_regex.fullmatch(path, len(base))
+            negated = dir_negated
+        elif file_regex:
+            match = file_regex.fullmatch(path, len(base))
+            negated = file_negated
         else:
-            result += get_files(path)
+            continue
+        if match:
+            return not negated[match.lastindex - 1]
+    return False
+
+
+def get_files(dir_name):
+    # get all files from dir_name which are not ignored, ignored
+    # directories are not entered
+    top = dir_name = os.path.normpath(dir_name)
+    cache = read_untracked_cache()
+    visited = {}
+    result = []
+    changed = False
+    dirs = [(dir_name, get_ignore_rules(os.path.dirname(dir_name) or '.'))]
+    with trace_phase('walk'):
+        while dirs:
+            dir_name, rules = dirs.pop()
+            files, subdirs, listed = list_dir(dir_name, cache)
+            visited[dir_name] = cache[dir_name]
+            changed = changed or listed
+            prefix = '' if dir_name == '.' else dir_name + '/'
+            if '.lgitignore' in files and dir_name != '.':
+                compiled = compile_ignore_file(prefix + '.lgitignore', prefix)
+                if compiled:
+                    rules = rules + [compiled]
+            for name in files:
+                if not is_ignored(rules, prefix + name, False):
+                    result.append(prefix + name)
+            for name in reversed(subdirs):
+                if not is_ignored(rules, prefix + name, True):
+                    dirs.append((prefix + name, rules))
+    # a walk of the whole tree also forgets the directories not seen again
+    if top == '.' and len(visited) != len(cache):
+        cache = visited
+        changed = True
+    if changed:
+        write_untracked_cache(cache)
     return result
 
 
-def lgit_add(filenames):
+def get_untracked_files(index):
+    # get the files missing from the index; a directory holding no tracked
+    # file at all is shown once, as "dir/"
+    tracked_dirs = set()
+    for name in index:
+        parts = name.split('/')
+        for i in range(1, len(parts)):
+            tracked_dirs.add('/'.join(parts[:i]))
+    untracked = set()
+    for name in get_files('.'):
+        if name in index:
+            continue
+        parts = name.split('/')
+        for i in range(1, len(parts)):
+            if '/'.join(parts[:i]) not in tracked_dirs:
+                name = '/'.join(parts[:i]) + '/'
+                break
+        untracked.add(name)
+    return sorted(untracked)
+
+
+# .lgit/untracked-cache is a json file saving the listing of every
+# directory with its mtime, so unchanged directories are not listed again
+UNTRACKED_CACHE_VERSION = 1
+
+
+# .lgit/index layout: a header, one fixed-size record per entry sorted by
+# path, the table of paths the records point into, then a SHA-1 of all that
+INDEX_SIGNATURE = b'LIDX'
+INDEX_VERSION = 2
+INDEX_HEADER = struct.Struct('>4sII')
+# size, inode, ctime, mtime, working/staged/committed hashes, flags,
+# path offset and path length; the hashes are as long as the digests of
+# the repository's hash algorithm
+INDEX_RECORDS = {}
+INDEX_HAS_STAT = 1
+INDEX_HAS_COMMITTED = 2
+# the file was deleted from the working directory, its working hash is ''
+INDEX_DELETED = 4
+# first line of the previous, text based index format
+TEXT_INDEX_HEADER = 'lgit index 2\n'
+# stat data of a file modified this close (in ns) to an index write is not
+# trusted: a later change within the same timestamp would go unnoticed
+RACY_WINDOW = 1000000000
+
+# the index is parsed once per invocation
+cached_index = None
+
+
+def get_stat_data(st):
+    # the part of os.stat() that tells if a file changed since it was hashed
+    return st.st_size, st.st_ino, st.st_ctime_ns, st.st_mtime_ns
+
+
+def new_index_entry(hash_value, st, committed=''):
+    return {'working': hash_value, 'staged': hash_value,
+            'committed': committed, 'stat': get_stat_data(st)}
+
+
+def parse_text_index(content):
+    # read an index written by an older lgit, it is converted to the
+    # binary format on the next write
+    lines = content.decode().splitlines(True)
+    has_stat = lines[:1] == [TEXT_INDEX_HEADER]
+    if has_stat:
+        lines = lines[1:]
+    index = {}
+    for line in lines:
+        entry = {'working': line[15:55], 'staged': line[56:96],
+                 'committed': line[97:137].strip(), 'stat': None}
+        name = line[138:-1]
+        if has_stat:
+            fields = name.split(' ', 4)
+            if fields[0] != '-':
+                entry['stat'] = tuple(int(field) for field in fields[:4])
+            name = fields[4]
+        index[name] = entry
+    # like a binary index, it is read in path order
+    return dict(sorted(index.items()))
+
+
+def get_index_record():
+    size = get_digest_size()
+    if size not in INDEX_RECORDS:
+        INDEX_RECORDS[size] = struct.Struct('>QQqq%ds%ds%dsHIH'
+                                            % (size, size, size))
+    return INDEX_RECORDS[size]
+
+
+def parse_index(content):
+    if not content.startswith(INDEX_SIGNATURE):
+        return parse_text_index(content)
+    if hashlib.sha1(content[:-20]).digest() != content[-20:]:
+        raise LgitError('fatal: index file corrupt')
+    signature, version, count = INDEX_HEADER.unpack_from(content)
+    if version != INDEX_VERSION:
+        raise LgitError('fatal: unknown index file version %d' % version)
+
+    index_record = get_index_record()
+    records_end = INDEX_HEADER.size + count * index_record.size
+    paths = content[records_end:-20]
+    index = {}
+    for (size, ino, ctime, mtime, working, staged, committed, flags,
+         offset, length) in index_record.iter_unpack(
+            content[INDEX_HEADER.size:records_end]):
+        entry = {'working': working.hex(), 'staged': staged.hex(),
+                 'committed': '', 'stat': None}
+        if flags & INDEX_DELETED:
+            entry['working'] = ''
+        if flags & INDEX_HAS_COMMITTED:
+            entry['committed'] = committed.hex()
+        if flags & INDEX_HAS_STAT:
+            entry['stat'] = (size, ino, ctime, mtime)
+        index[os.fsdecode(paths[offset:offset + length])] = entry
+    return index
+
+
+def read_index():
+    # get index's content as {path: entry}
+    global cached_index
+    if cached_index is None:
+        with trace_phase('read_index'):
+            file = open('.lgit/index', 'rb')
+            cached_index = parse_index(file.read())
+            file.close()
+    return cached_index
+
+
+def write_index(index):
+    global cached_index
+    now = time.time_ns()
+    index_record = get_index_record()
+    no_hash = bytes(get_digest_size())
+    records = []
+    paths = []
+    offset = 0
+    for name in sorted(index):
+        entry = index[name]
+        path = os.fsencode(name)
+        flags = 0
+        stat = entry['stat']
+        # racily clean entries are written without stat data so the next
+        # command rehashes them
+        if stat is None or stat[3] >= now - RACY_WINDOW:
+            stat = (0, 0, 0, 0)
+        else:
+            flags |= INDEX_HAS_STAT
+        committed = no_hash
+        if entry['committed']:
+            committed = bytes.fromhex(entry['committed'])
+            flags |= INDEX_HAS_COMMITTED
+        working = no_hash
+        if entry['working']:
+            working = bytes.fromhex(entry['working'])
+        else:
+            flags |= INDEX_DELETED
+        records.append(index_record.pack(
+            stat[0], stat[1], stat[2], stat[3],
+            working, bytes.fromhex(entry['staged']),
+            committed, flags, offset, len(path)))
+        paths.append(path)
+        offset += len(path)
+    content = b''.join([INDEX_HEADER.pack(INDEX_SIGNATURE, INDEX_VERSION,
+                                          len(records))] + records + paths)
+    with trace_phase('write_index'):
+        write_file('.lgit/index', content + hashlib.sha1(content).digest())
+    cached_index = index
+
+
+def get_stale_stat(name, entry, index_mtime):
+    # return the new stat data of a tracked file that has to be rehashed,
+    # or None if its stat data shows it is unchanged; FileNotFoundError
+    # tells the file was deleted
+    trace_count('files_stated')
+    st = os.stat(name)
+    stat = get_stat_data(st)
+    # a file modified at (or after) the last index write may have changed
+    # again within the same timestamp, so it is "racy" and always rehashed
+    if stat == entry['stat'] and st.st_mtime_ns < index_mtime:
+        return None
+    return stat
+
+
+def run_jobs(func, items, jobs):
+    # call func on every item with up to jobs threads, hashing and file
+    # I/O release the GIL; results keep the order of items
+    if jobs < 2 or len(items) < 2:
+        return [func(item) for item in items]
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        return list(executor.map(func, items))
+
+
+def add_object(name):
+    # stat before hashing so a change made while hashing is noticed
+    st = os.stat(name)
+    return st, store_file(name)
+
+
+def stage_files(index, filenames, jobs=1):
+    # add files and directories to index, return the names of the files
+    # staged
 
     # get all files from inputs
     names = []
@@ -93,137 +1758,199 @@ def lgit_add(filenames):
         for name in filenames:
             if os.path.isfile(name):
                 names.append(name)
-            else:
+            elif os.path.isdir(name):
                 names += get_files(name)
 
-    for name in names:
-        content, hash_value = get_hash(name)
-        tim = datetime.datetime.fromtimestamp(os.stat(name).st_mtime)
-        tstamp = tim.strftime("%Y%m%d%H%M%S")
+    # tracked files whose content is already staged need not be read again
+    # unless their stat data changed since the index was refreshed, which
+    # may have been long ago for a Repository
+    if '.' in filenames or '*' in filenames:
+        # tracked files stay tracked even when they are ignored
+        found = set(names)
+        names += [name for name in index
+                  if name not in found and os.path.isfile(name)]
+    try:
+        index_mtime = os.stat('.lgit/index').st_mtime_ns
+    except FileNotFoundError:
+        index_mtime = 0
+    names = [name for name in names if name not in index or
+             index[name]['working'] != index[name]['staged'] or
+             get_stale_stat(name, index[name], index_mtime) is not None]
+
+    # tracked files deleted from the working directory are staged as
+    # deleted, leaving the index; below directories, only the ones
+    # update_index() found deleted are looked at
+    paths = set(filenames)
+    prefixes = tuple(path.rstrip('/') + '/' for path in filenames)
+    every = '.' in paths or '*' in paths
+    deleted = [name for name, entry in index.items()
+               if (name in paths or not entry['working'] and
+                   (every or name.startswith(prefixes))) and
+               not os.path.lexists(name)]
+    for path in paths - {'.', '*'}:
+        if not os.path.lexists(path) and not any(
+                name == path or name.startswith(path.rstrip('/') + '/')
+                for name in deleted):
+            raise LgitError('fatal: pathspec \'%s\' did not match any files'
+                            % path)
+    for name in deleted:
+        del index[name]
+
+    # hash and store the files in parallel, then update the index once
+    with trace_phase('store'):
+        results = run_jobs(add_object, names, jobs)
+    for name, (st, hash_value) in zip(names, results):
+        if name in index:
+            entry = index[name]
+            entry['working'] = hash_value
+            entry['staged'] = hash_value
+            entry['stat'] = get_stat_data(st)
+        else:
+            # if file has never been added
+            index[name] = new_index_entry(hash_value, st)
+    return names + deleted
 
-        # create a file which store content in SHA1 value of current file
-        dir_name = '.lgit/objects/%s/' % hash_value[:2]
-        if not os.path.exists(dir_name):
-            os.mkdir(dir_name)
-        fd = open(dir_name + hash_value[2:], 'w')
-        fd.write(content)
-        fd.close()
 
-        # update file index
-        file_index = open('.lgit/index', 'r')
-        index_content = file_index.readlines()
-        file_index.close()
-        flag = 1
-        fd = os.open('.lgit/index', os.O_WRONLY)
-        os.lseek(fd, 0, 0)
-        for line in index_content:
-            if line[138:-1] == name:
-                # update timestamp
-                os.write(fd, bytes(tstamp, 'utf-8'))
-                os.lseek(fd, 42, 1)
-                # update hash value in field3
-                os.write(fd, hash_value.encode())
-                flag = 0
-                break
-            else:
-                os.lseek(fd, len(line), 1)
-        if flag:
-            # if file has never been added
-            empty_hash = ' ' * 40
-            os.write(fd, bytes('%s %s %s %s %s\n' % (tstamp, hash_value,
-                                                     hash_value, empty_hash,
-                                                     name), 'utf-8'))
-        os.close(fd)
+def lgit_add(repo, filenames):
+    repo.add(filenames)
 
 
 # remove index content of the file
-def rm_index(filename):
-    file = open('.lgit/index', 'r')
-    contents = file.readlines()
-    i = 0
-    flag = 0
-    while i < len(contents):
-        if contents[i].endswith(filename + '\n'):
-            contents.pop(i)
-            flag = 1
-        i += 1
-    file.close()
-    content = ''.join(contents)
-    f = open('.lgit/index', 'w')
-    f.write(content)
-    f.close()
-    return flag
+def rm_index(index, filename):
+    if filename not in index:
+        return 0
+    del index[filename]
+    return 1
 
 
-def lgit_rm(filenames):
+def remove_files(index, filenames):
+    # remove files from the working directory and index, return the error
+    # messages of the ones which could not be
+    errors = []
     for filename in filenames:
         if os.path.isdir(filename):
-            print('fatal: not removing \'%s\' recursively' % filename)
-            exit()
-        if os.path.exists(filename):
-            flag = rm_index(filename)
-            # if filename exist in index file
-            if flag:
+            errors.append('fatal: not removing \'%s\' recursively'
+                          % filename)
+            break
+        # a tracked file already deleted from the working directory only
+        # leaves the index
+        if rm_index(index, filename):
+            if os.path.lexists(filename):
                 os.remove(filename)
-            else:
-                print('fatal: pathspec \'%s\' did not match any files'
-                      % filename)
         else:
-            print('fatal: pathspec \'%s\' did not match any files' % filename)
+            errors.append('fatal: pathspec \'%s\' did not match any files'
+                          % filename)
+    return errors
+
+
+def lgit_rm(repo, filenames):
+    # the files which can be are still removed after an error
+    for error in repo.remove(filenames):
+        print(error)
+
+
+def get_current_branch():
+    head_file = open('.lgit/HEAD', 'r')
+    head_content = head_file.read()
+    head_file.close()
+    return head_content.strip('\n').split('/')[-1]
 
 
-def lgit_commit(message):
+def get_branches():
+    # lock files of the branches being updated are not branches
+    return [name for name in os.listdir('.lgit/refs/heads')
+            if not name.endswith('.lock')]
 
-    # get index's content
-    file_index = open('.lgit/index', 'r')
-    lines = file_index.readlines()
-    file_index.close()
 
-    if lines:
+def get_branch_commit(branch):
+    # get the last commit of a branch, None if it has none yet
+    try:
+        ref = open('.lgit/refs/heads/%s' % branch, 'r')
+    except FileNotFoundError:
+        return None
+    commit = ref.readline().strip('\n')
+    ref.close()
+    return commit or None
+
+
+def get_new_commit_name(name):
+    # .lgit/commit-graph and .lgit/log/index are searched by name, so a new
+    # commit is named after the last one when the clock went back, e.g. at
+    # the end of daylight saving time; commits are made under the index
+    # lock, one at a time
+    graph = open_records('.lgit/commit-graph')
+    if graph is None:
+        return name
+    last = read_graph_record(graph, len(graph) // GRAPH_RECORD.size - 1)[0]
+    graph.close()
+    if name > last:
+        return name
+    tim = datetime.datetime.strptime(last, '%Y%m%d%H%M%S.%f')
+    return (tim + datetime.timedelta(microseconds=1)).strftime(
+        '%Y%m%d%H%M%S.%f')
+
+
+def make_commit(index, message):
+    # commit the staged files of index, which the caller writes, and
+    # return the new commit's name
+    if index:
         # get timestamp
         tim = datetime.datetime.fromtimestamp(time.time())
         ms_timestamp = tim.strftime("%Y%m%d%H%M%S.%f")
         tstamp = tim.strftime("%Y%m%d%H%M%S")
 
-        # create file in commits dir
-        commit = open('.lgit/commits/%s' % ms_timestamp, 'w+')
-        f = open('.lgit/config', 'r')
-        # get logname from file config
-        logname = f.read().strip('\n')
-        f.close()
-        commit.write('%s\n%s\n\n%s\n\n' % (logname, tstamp, message))
-        commit.close()
-
-        # update file index
-        fd = os.open('.lgit/index', os.O_WRONLY)
-        os.lseek(fd, 0, 0)
-        for line in lines:
-            hash_value = line[56:96]
-            name = line[138:]
-            snapshot = open('.lgit/snapshots/%s' % ms_timestamp, 'a+')
-            snapshot.write(hash_value + ' ' + name)
-            snapshot.close()
-            os.lseek(fd, 97, 1)
-            os.write(fd, hash_value.encode())
-            os.lseek(fd, len(line)-137, 1)
-        os.close(fd)
-
-        # bonus
-        f = open('.lgit/HEAD', 'r')
-        content = f.read()
-        f.close()
-        if 'master' in content:
-            fd = open('.lgit/refs/heads/master', 'w')
-            fd.write(ms_timestamp)
-            fd.close()
-        else:
-            curbranch = content.strip('\n').split('/')[-1]
-            fd = open('.lgit/refs/heads/%s' % curbranch, 'w')
-            fd.write(ms_timestamp)
-            fd.close()
-        # end bonus
+        # create file in commits dir, it ends with the commit's parent
+        # and tree
+        update_log_index()
+        update_commit_graph()
+        ms_timestamp = get_new_commit_name(ms_timestamp)
+        ref_path = '.lgit/refs/heads/' + get_current_branch()
+        lock_file(ref_path)
+        # the ref is unlocked even on an error, another commit of the same
+        # process would wait for it otherwise
+        try:
+            parents = []
+            parent_tree = None
+            parent = get_branch_commit(get_current_branch())
+            if parent:
+                parents.append(parent)
+                parent_tree = read_commit_trailer(parent)[1]
+
+            # only the trees of the directories with changes are written
+            with trace_phase('write_trees'):
+                tree = write_trees(build_trees(
+                    {name: entry['staged'] for name, entry in index.items()}),
+                    parent_tree)
+            commit = open('.lgit/commits/%s' % ms_timestamp, 'w+')
+            # get logname from file config
+            logname = get_config('user.author', '')
+            commit.write('%s\n%s\n\n%s\n\n' % (logname, tstamp, message))
+            for parent in parents:
+                commit.write('parent %s\n' % parent)
+            commit.write('tree %s\n' % tree)
+            commit.close()
+            append_log_record(ms_timestamp, int(tim.timestamp()), logname,
+                              message)
+            append_commit_graph(ms_timestamp, parents)
+
+            # update file index
+            for entry in index.values():
+                entry['committed'] = entry['staged']
+
+            # bonus
+            write_file(ref_path, ms_timestamp.encode())
+            # end bonus
+        finally:
+            unlock_file(ref_path)
+        return ms_timestamp
+    raise LgitError('nothing added to commit')
+
+
+def lgit_commit(repo, message):
+    if repo.index:
+        repo.commit(message)
     else:  # if commit without ever have added yet, show the untracked files
-        lgit_status()
+        lgit_status(repo)
 
 
 def print_status():
@@ -248,139 +1975,857 @@ def print_to_be_committed(files):
     print('\n\t modified: %s\n' % '\n\t modified: '.join(files))
 
 
-def print_not_staged_for_commit(files):
+def print_not_staged_for_commit(files, deleted=()):
     print('Changes not staged for commit:')
-    print('  (use "./lgit.py add ..." to update what will be committed)')
+    print('  (use "./lgit.py add/rm ..." to update what will be committed)')
     print('  (use "./lgit.py checkout -- ..." to '
           'discard changes in working directory)')
-    print('\n\t modified: %s\n' % '\n\t modified: '.join(files))
+    print()
+    for name in files:
+        print('\t %s: %s' % ('deleted' if name in deleted else 'modified',
+                             name))
+    print()
+
+
+def get_status(index):
+    # get the staged, modified and untracked files of an index refreshed
+    # by update_index()
+    with trace_phase('untracked'):
+        untracked_files = get_untracked_files(index)
+    to_be_committed = []
+    not_staged_for_commit = []
+    deleted = []
+
+    for name in sorted(index):
+        entry = index[name]
+        if entry['working'] != entry['staged']:
+            not_staged_for_commit.append(name)
+            if not entry['working']:
+                deleted.append(name)
+        elif entry['committed'] != entry['staged']:
+            to_be_committed.append(name)
+    return {'to_be_committed': to_be_committed,
+            'not_staged': not_staged_for_commit,
+            'deleted': deleted,
+            'untracked': untracked_files}
+
+
+def lgit_status(repo):
+    print_status()
+    status = repo.status()
+    if status['to_be_committed']:
+        print_to_be_committed(status['to_be_committed'])
+    if status['not_staged']:
+        print_not_staged_for_commit(status['not_staged'],
+                                    set(status['deleted']))
+    if status['untracked']:
+        print_untrackeds(status['untracked'])
+
+
+def lgit_ls_file(repo, curpath, zero=False):
+    # with zero, names are written as they are, each followed by a NUL
+    out = sys.stdout.buffer
+    end = b'\0' if zero else b'\n'
+    try:
+        for filename in repo.files():
+            if curpath == '':
+                if filename != '':
+                    out.write(os.fsencode(filename) + end)
+            # in case lgit is called from inner dir, cut dir-name
+            elif curpath in filename:
+                temp = filename.split(curpath)
+                out.write(os.fsencode(temp[-1]) + end)
+        out.flush()
+    except BrokenPipeError:
+        # the reader, e.g. `| head`, has seen enough
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+
+def read_stdin_paths(zero=False):
+    # yield the paths given on stdin one per line, or NUL terminated with
+    # zero, reading it block by block
+    end = b'\0' if zero else b'\n'
+    rest = b''
+    block = sys.stdin.buffer.read1(BLOCK_SIZE)
+    while block:
+        paths = (rest + block).split(end)
+        rest = paths.pop()
+        for path in paths:
+            if path:
+                yield os.fsdecode(path)
+        block = sys.stdin.buffer.read1(BLOCK_SIZE)
+    if rest:
+        yield os.fsdecode(rest)
+
+
+def set_config(name, value):
+    # set the option section.key of .lgit/config
+    if '.' not in name:
+        raise LgitError('error: key does not contain a section: %s' % name)
+    section, key = name.split('.', 1)
+    config = read_config()
+    if not config.has_section(section):
+        config.add_section(section)
+    config.set(section, key, value)
+    write_config(config)
+
+
+def lgit_config(repo, name, value):
+    repo.set_config(name, value)
+
+
+def lgit_config_author(repo, author):
+    repo.set_config('user.author', author)
+
+
+def read_log_authors(log_dir='.lgit/log'):
+    file = open(log_dir + '/authors', 'r')
+    authors = file.read().splitlines()
+    file.close()
+    return authors
+
+
+def append_log_record(commit_name, timestamp, author, message,
+                      log_dir='.lgit/log'):
+    # the message is written before the record pointing to it
+    authors = read_log_authors(log_dir)
+    if author not in authors:
+        file = open(log_dir + '/authors', 'a')
+        file.write(author + '\n')
+        file.close()
+        authors.append(author)
+    message = message.encode()
+    file = open(log_dir + '/messages', 'ab')
+    offset = file.seek(0, os.SEEK_END)
+    file.write(message)
+    file.close()
+    file = open(log_dir + '/index', 'ab')
+    file.write(LOG_RECORD.pack(commit_name.encode(), int(timestamp),
+                               authors.index(author), offset, len(message)))
+    file.close()
 
 
-def lgit_status():
-    print_status()
+def update_log_index():
+    # build the log index of a repository created by an older lgit, from
+    # its commit files. It is built in a temporary directory renamed to
+    # .lgit/log when complete, under a lock as read-only commands do it too
+    if os.path.exists('.lgit/log/index'):
+        return
+    lock_file('.lgit/log')
+    try:
+        if os.path.exists('.lgit/log/index'):
+            return
+        tmp_dir = tempfile.mkdtemp(prefix='tmp_log_', dir='.lgit')
+        for name in ['authors', 'messages', 'index']:
+            open(tmp_dir + '/' + name, 'a').close()
+        for commit_name in sorted(os.listdir('.lgit/commits')):
+            file = open('.lgit/commits/' + commit_name, 'r')
+            lines = file.readlines()
+            file.close()
+            tim = datetime.datetime.strptime(lines[1].strip('\n'),
+                                             '%Y%m%d%H%M%S')
+            append_log_record(commit_name, tim.timestamp(),
+                              lines[0].strip('\n'), lines[3].strip('\n'),
+                              tmp_dir)
+        # what an interrupted build of an older lgit left is replaced
+        if os.path.exists('.lgit/log'):
+            shutil.rmtree('.lgit/log')
+        os.rename(tmp_dir, '.lgit/log')
+    finally:
+        unlock_file('.lgit/log')
+
+
+def open_records(path):
+    # map a file of fixed-size records in memory, None if it is empty
+    file = open(path, 'rb')
+    records = None
+    if os.fstat(file.fileno()).st_size:
+        records = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    file.close()
+    return records
+
+
+def find_record(records, record, name):
+    # binary search the position of a commit in a file of records sorted
+    # by commit name, None if it is not there
+    if records is None:
+        return None
+    name = name.encode()
+    lo = 0
+    hi = len(records) // record.size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        current = records[mid * record.size:mid * record.size + 21]
+        if current < name:
+            lo = mid + 1
+        elif current > name:
+            hi = mid
+        else:
+            return mid
+    return None
+
 
-    # get index's content
-    file = open('.lgit/index', 'r')
-    lines = file.readlines()
+def read_commit_trailer(commit_name):
+    # get the parents and tree written at the end of a commit file; the
+    # parents are None for commits made before lgit recorded them, and the
+    # tree is None for commits whose files are only in their snapshot
+    file = open('.lgit/commits/' + commit_name, 'r')
+    lines = file.read().splitlines()
     file.close()
+    parents = []
+    tree = None
+    found = False
+    while lines and lines[-1].startswith(('parent ', 'snapshot ', 'tree ')):
+        key, value = lines.pop().split(' ', 1)
+        found = True
+        if key == 'parent':
+            parents.insert(0, value)
+        elif key == 'tree':
+            tree = value
+    if not found:
+        return None, None
+    return parents, tree
 
-    # filenames = get_files('.')
-    filenames = os.listdir(".")
-    untracked_files = []
-    to_be_committed = []
-    not_staged_for_commit = []
 
-    for name in filenames:
-        if not os.path.isfile(name):
-            untracked_files.append(name + '/')
-            continue
+def read_commit_files(commit_name, cache=None):
+    # get {path: hash} of the files of a commit
+    tree = read_commit_trailer(commit_name)[1]
+    if tree is None:
+        return read_snapshot(commit_name)
+    return read_tree_files(tree, cache)
 
-        # check index file
-        fd = os.open('.lgit/index', os.O_WRONLY)
-        os.lseek(fd, 0, 0)
-        content, hash_value = get_hash(name)
-        tim = datetime.datetime.fromtimestamp(os.stat(name).st_mtime)
-        tstamp = tim.strftime("%Y%m%d%H%M%S")
 
-        # find the line contain info of current file
-        curline = None
-        for line in lines:
-            if line[138:-1] == name:
-                curline = '%s %s %s' % (tstamp, hash_value, line[56:])
-                break
+def update_commit_graph():
+    # build the commit graph of a repository created by an older lgit;
+    # commits that do not name their parent are chained in time order,
+    # which is how `lgit log` used to show them
+    if os.path.exists('.lgit/commit-graph'):
+        return
+    lock_file('.lgit/commit-graph')
+    try:
+        if os.path.exists('.lgit/commit-graph'):
+            return
+        previous = None
+        fd, tmp_path = tempfile.mkstemp(prefix='tmp_graph_', dir='.lgit')
+        os.close(fd)
+        for commit_name in sorted(os.listdir('.lgit/commits')):
+            parents = read_commit_trailer(commit_name)[0]
+            if parents is None:
+                parents = [previous] if previous else []
+            append_commit_graph(commit_name, parents, tmp_path)
+            previous = commit_name
+        os.replace(tmp_path, '.lgit/commit-graph')
+    finally:
+        unlock_file('.lgit/commit-graph')
+
+
+def append_commit_graph(commit_name, parents, path='.lgit/commit-graph'):
+    # a commit's generation is one more than the highest of its parents'
+    graph = open_records(path)
+    generation = 1
+    positions = []
+    for parent in parents:
+        position = find_record(graph, GRAPH_RECORD, parent)
+        positions.append(position)
+        generation = max(generation, GRAPH_RECORD.unpack_from(
+            graph, position * GRAPH_RECORD.size)[1] + 1)
+    if graph is not None:
+        graph.close()
+    positions = (positions + [-1, -1])[:2]
+    file = open(path, 'ab')
+    file.write(GRAPH_RECORD.pack(commit_name.encode(), generation,
+                                 positions[0], positions[1]))
+    file.close()
+
+
+def read_graph_record(graph, position):
+    # get (name, generation, parent positions) of a commit
+    name, generation, first, second = GRAPH_RECORD.unpack_from(
+        graph, position * GRAPH_RECORD.size)
+    return name.decode(), generation, [p for p in (first, second) if p >= 0]
+
+
+def walk_commits(graph, tips):
+    # yield the positions of the commits reachable from the positions in
+    # tips, newest first, only reading the records that are consumed
+    heap = [(-position, position) for position in tips]
+    heapq.heapify(heap)
+    seen = set(tips)
+    while heap:
+        position = heapq.heappop(heap)[1]
+        yield position
+        for parent in read_graph_record(graph, position)[2]:
+            if parent not in seen:
+                seen.add(parent)
+                heapq.heappush(heap, (-parent, parent))
+
+
+def is_ancestor(graph, ancestor, descendant):
+    # walk back from descendant, never below the generation of ancestor
+    generation = read_graph_record(graph, ancestor)[1]
+    stack = [descendant]
+    seen = set(stack)
+    while stack:
+        position = stack.pop()
+        if position == ancestor:
+            return True
+        for parent in read_graph_record(graph, position)[2]:
+            if (parent not in seen and
+                    read_graph_record(graph, parent)[1] >= generation):
+                seen.add(parent)
+                stack.append(parent)
+    return False
+
+
+def find_merge_base(graph, first, second):
+    # commits are visited by decreasing generation so all the children of
+    # a commit are seen before it: the first one reached from both sides
+    # is a best common ancestor
+    if first == second:
+        return first
+    flags = {first: 1, second: 2}
+    heap = [(-read_graph_record(graph, position)[1], position)
+            for position in flags]
+    heapq.heapify(heap)
+    while heap:
+        position = heapq.heappop(heap)[1]
+        if flags[position] == 3:
+            return position
+        for parent in read_graph_record(graph, position)[2]:
+            if parent not in flags:
+                flags[parent] = 0
+                heapq.heappush(heap, (-read_graph_record(graph, parent)[1],
+                                      parent))
+            flags[parent] |= flags[position]
+    return None
+
+
+def resolve_commit(graph, name):
+    # get the graph position of a branch or commit name
+    if os.path.isfile('.lgit/refs/heads/' + name):
+        name = get_branch_commit(name)
+    position = find_record(graph, GRAPH_RECORD, name)
+    if position is None:
+        raise LgitError('fatal: Not a valid object name: \'%s\'.' % name)
+    return position
+
+
+def get_merge_base(first, second):
+    # get the name of the best common ancestor of two commits or branches,
+    # None if they have none
+    update_commit_graph()
+    graph = open_records('.lgit/commit-graph')
+    base = find_merge_base(graph, resolve_commit(graph, first),
+                           resolve_commit(graph, second))
+    if base is None:
+        return None
+    return read_graph_record(graph, base)[0]
+
+
+def check_ancestor(first, second):
+    # tell if the commit or branch first is an ancestor of second
+    update_commit_graph()
+    graph = open_records('.lgit/commit-graph')
+    return is_ancestor(graph, resolve_commit(graph, first),
+                       resolve_commit(graph, second))
+
+
+def lgit_merge_base(repo, names, ancestor=False):
+    if len(names) != 2:
+        exit('usage: ./lgit.py merge-base [--is-ancestor] <commit> <commit>')
+    if ancestor:
+        exit(0 if repo.is_ancestor(*names) else 1)
+    base = repo.merge_base(*names)
+    if base is None:
+        exit(1)
+    print(base)
+
+
+def read_diff_content(blocks):
+    # get the content of a file to diff, None if it is too big
+    content = []
+    size = 0
+    for block in blocks:
+        size += len(block)
+        if size > DIFF_MAX_SIZE:
+            return None
+        content.append(block)
+    return b''.join(content)
+
+
+def iter_working_file(filename):
+    file = open(filename, 'rb')
+    block = file.read(BLOCK_SIZE)
+    while block:
+        yield block
+        block = file.read(BLOCK_SIZE)
+    file.close()
+
+
+def trim_lines(a, b, a_lo, a_hi, b_lo, b_hi, matches):
+    # match the common prefix and suffix of two ranges, return what is left
+    while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+        matches.append((a_lo, b_lo))
+        a_lo += 1
+        b_lo += 1
+    while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+        a_hi -= 1
+        b_hi -= 1
+        matches.append((a_hi, b_hi))
+    return a_lo, a_hi, b_lo, b_hi
+
+
+def find_unique_anchors(a, b, a_lo, a_hi, b_lo, b_hi):
+    # get the longest increasing run of lines found once in both ranges, the
+    # patience diff anchors between which the ranges are diffed again
+    a_range = a[a_lo:a_hi]
+    b_range = b[b_lo:b_hi]
+    a_counts = collections.Counter(a_range)
+    b_counts = collections.Counter(b_range)
+    b_positions = dict(zip(b_range, range(b_lo, b_hi)))
+    pairs = [(i, b_positions[line])
+             for i, line in zip(range(a_lo, a_hi), a_range)
+             if a_counts[line] == 1 and b_counts[line] == 1]
+    # patience sorting: tails[n] is the pair ending the best run of length
+    # n + 1, links[p] the pair before pairs[p] in its run
+    tails = []
+    tail_lines = []
+    links = []
+    for p, (i, j) in enumerate(pairs):
+        if tail_lines and j > tail_lines[-1]:
+            n = len(tails)
+        else:
+            n = bisect.bisect_left(tail_lines, j)
+        links.append(tails[n - 1] if n else -1)
+        if n == len(tails):
+            tails.append(p)
+            tail_lines.append(j)
+        else:
+            tails[n] = p
+            tail_lines[n] = j
+    anchors = []
+    p = tails[-1] if tails else -1
+    while p >= 0:
+        anchors.append(pairs[p])
+        p = links[p]
+    anchors.reverse()
+    return anchors
+
+
+def myers_lines(a, b, a_lo, a_hi, b_lo, b_hi, matches):
+    # match the lines of two ranges with the Myers O(ND) algorithm, giving
+    # up and matching nothing after DIFF_MAX_COST edits
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    v = {1: 0}
+    trace = []
+    for d in range(min(n + m, DIFF_MAX_COST) + 1):
+        trace.append(dict(v))
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
             else:
-                os.lseek(fd, len(line), 1)
-        if curline:
-            # check if field3 != field2: append -> not_staged_for_commit
-            if curline[56:96] != curline[15:55]:
-                not_staged_for_commit.append(name)
-            # check if field4 != field3: append -> to_be_committed
-            elif curline[97:137] != curline[56:96]:
-                to_be_committed.append(name)
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                break
         else:
-            untracked_files.append(name)
-        os.close(fd)
-    if to_be_committed:
-        print_to_be_committed(to_be_committed)
-    if not_staged_for_commit:
-        print_not_staged_for_commit(not_staged_for_commit)
-    if untracked_files:
-        print_untrackeds(untracked_files)
-
-
-def lgit_ls_file(curpath):
-    f = open('.lgit/index', 'r')
-    content = f.read()
-    elements = content.split('\n')
-    filenames = []
-    for i in elements:
-        temp = i.split(' ')
-        filenames.append(temp[-1])
-    filenames.sort()
-    for filename in filenames:
-        if curpath == '':
-            if filename != '':
-                print(filename)
-        # in case lgit is called from inner dir, cut dir-name
-        elif curpath in filename:
-            temp = filename.split(curpath)
-            print(temp[-1])
+            continue
+        break
+    else:
+        return
+
+    # walk the edits back from the end
+    x, y = n, m
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            matches.append((a_lo + x, b_lo + y))
+        x, y = prev_x, prev_y
+
+
+def diff_lines(a, b):
+    # get the sorted (i, j) pairs of matching lines of a and b, lists of
+    # hashed lines: common prefix and suffix are trimmed, lines unique on
+    # both sides anchor the diff and what is between anchors goes to Myers
+    matches = []
+    ranges = [(0, len(a), 0, len(b))]
+    while ranges:
+        a_lo, a_hi, b_lo, b_hi = trim_lines(a, b, *ranges.pop(), matches)
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
+        anchors = find_unique_anchors(a, b, a_lo, a_hi, b_lo, b_hi)
+        if not anchors:
+            myers_lines(a, b, a_lo, a_hi, b_lo, b_hi, matches)
+            continue
+        for i, j in anchors:
+            matches.append((i, j))
+            if i > a_lo or j > b_lo:
+                ranges.append((a_lo, i, b_lo, j))
+            a_lo, b_lo = i + 1, j + 1
+        ranges.append((a_lo, a_hi, b_lo, b_hi))
+    matches.sort()
+    return matches
+
+
+def get_diff_hunks(a_size, b_size, matches):
+    # group the changed ranges (i1, i2, j1, j2) between matching lines into
+    # hunks, changes closer than twice the context share a hunk
+    hunks = []
+    i = j = 0
+    for x, y in matches + [(a_size, b_size)]:
+        if x > i or y > j:
+            if hunks and i - hunks[-1][-1][1] <= 2 * DIFF_CONTEXT:
+                hunks[-1].append((i, x, j, y))
+            else:
+                hunks.append([(i, x, j, y)])
+        i, j = x + 1, y + 1
+    return hunks
 
 
-def lgit_config_author(author):
-    f = open('.lgit/config', 'w')
-    f.write(author + '\n')
-    f.close()
+def format_diff_range(start, length):
+    if length == 1:
+        return '%d' % (start + 1)
+    if length == 0:
+        return '%d,0' % start
+    return '%d,%d' % (start + 1, length)
 
 
-def lgit_log():
+def write_diff_lines(out, sign, lines):
+    for line in lines:
+        out.write(sign + line)
+        if not line.endswith(b'\n'):
+            out.write(b'\n\\ No newline at end of file\n')
+
+
+def print_file_diff(name, old_hash, new_hash, old_blocks, new_blocks):
+    # print the unified diff of one file, the contents are only read here
+    out = sys.stdout.buffer
+    out.write(('diff --lgit a/%s b/%s\n' % (name, name)).encode())
+    out.write(('index %s..%s\n' % ((old_hash or '0000000')[:7],
+                                   (new_hash or '0000000')[:7])).encode())
+    old = read_diff_content(old_blocks) if old_hash else b''
+    new = read_diff_content(new_blocks) if new_hash else b''
+    old_name = 'a/' + name if old_hash else '/dev/null'
+    new_name = 'b/' + name if new_hash else '/dev/null'
+    if old is None or new is None:
+        out.write(('Large files %s and %s differ\n'
+                   % (old_name, new_name)).encode())
+        return
+    if b'\0' in old[:DIFF_BINARY_CHECK] or b'\0' in new[:DIFF_BINARY_CHECK]:
+        out.write(('Binary files %s and %s differ\n'
+                   % (old_name, new_name)).encode())
+        return
+    old_lines = old.splitlines(True)
+    new_lines = new.splitlines(True)
+    # lines are compared as small integers
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in old_lines]
+    b = [ids.setdefault(line, len(ids)) for line in new_lines]
+    out.write(('--- %s\n+++ %s\n' % (old_name, new_name)).encode())
+    for hunk in get_diff_hunks(len(a), len(b), diff_lines(a, b)):
+        a_start = max(hunk[0][0] - DIFF_CONTEXT, 0)
+        a_end = min(hunk[-1][1] + DIFF_CONTEXT, len(a))
+        b_start = hunk[0][2] - (hunk[0][0] - a_start)
+        b_end = hunk[-1][3] + (a_end - hunk[-1][1])
+        out.write(('@@ -%s +%s @@\n' % (
+            format_diff_range(a_start, a_end - a_start),
+            format_diff_range(b_start, b_end - b_start))).encode())
+        position = a_start
+        for i1, i2, j1, j2 in hunk:
+            write_diff_lines(out, b' ', old_lines[position:i1])
+            write_diff_lines(out, b'-', old_lines[i1:i2])
+            write_diff_lines(out, b'+', new_lines[j1:j2])
+            position = i2
+        write_diff_lines(out, b' ', old_lines[position:a_end])
+
+
+def iter_file_diffs(index, names=(), cached=False):
+    # yield (name, old hash, new hash, old blocks, new blocks) for each file
+    # changed between the working files and the index, the index and the
+    # last commit, or two commits; the contents are only read when the
+    # blocks are, files whose hashes match never are
+    if names:
+        if len(names) != 2:
+            raise LgitError('usage: ./lgit.py diff [--cached | <commit> '
+                            '<commit>]')
+        update_commit_graph()
+        graph = open_records('.lgit/commit-graph')
+        old_commit, new_commit = [
+            read_graph_record(graph, resolve_commit(graph, name))[0]
+            for name in names]
+        old_tree = read_commit_trailer(old_commit)[1]
+        new_tree = read_commit_trailer(new_commit)[1]
+        if old_tree and new_tree:
+            changes = diff_trees(old_tree, new_tree)
+        else:
+            old_files = read_commit_files(old_commit)
+            new_files = read_commit_files(new_commit)
+            changes = {name: (old_files.get(name), new_files.get(name))
+                       for name in old_files.keys() | new_files.keys()
+                       if old_files.get(name) != new_files.get(name)}
+        files = [(name, old, new, new and iter_object(new))
+                 for name, (old, new) in changes.items()]
+    else:
+        files = []
+        for name, entry in index.items():
+            if cached and entry['committed'] != entry['staged']:
+                files.append((name, entry['committed'] or None,
+                              entry['staged'], iter_object(entry['staged'])))
+            elif not cached and entry['working'] != entry['staged']:
+                new = entry['working'] or None
+                files.append((name, entry['staged'], new,
+                              new and iter_working_file(name)))
+    for name, old, new, new_blocks in sorted(files):
+        yield name, old, new, old and iter_object(old), new_blocks
+
+
+def lgit_diff(repo, names, cached=False):
+    try:
+        for file_diff in repo.diff(names, cached):
+            print_file_diff(*file_diff)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # the reader, e.g. `| head`, has seen enough
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+
+def print_commit(tim, timestamp, author, message):
     months = {'01': 'Jan', '02': 'Feb', '03': 'Mar', '04': 'Apr',
               '05': 'May', '06': 'June', '07': 'Jul', '08': 'Aug',
               '09': 'Sep', '10': 'Oct', '11': 'Nov', '12': 'Dec'}
     weekdays = {0: 'Mon', 1: 'Tue', 2: 'Wed', 3: 'Thu', 4: 'Fri',
                 5: 'Sat', 6: 'Sun'}
-    # get files from directory .lgit/commits
-    timestamp = os.listdir('.lgit/commits')
-    timestamp.sort(reverse=True)
-    # traverse through files in directory .lgit/commits
-    for tim in timestamp:
-        f = open('.lgit/commits/%s' % tim, 'r')
-        lines = f.readlines()
-        # line[1]: timestamp of the commit file
-        t_stamp = str(lines[1])
-        year = t_stamp[:4]
-        month = t_stamp[4:6]
-        day = t_stamp[6:8]
-        hour = t_stamp[8:10]
-        minu = t_stamp[10:12]
-        sec = t_stamp[12:14]
-        weekday = calendar.weekday(int(year), int(month), int(day))
-        print('commit ' + tim)
-        print('Author: ' + lines[0].strip('\n'))
-        print('Date: {} {} {} {}:{}:{} {} \n'.format(weekdays[weekday],
-                                                     months[month], day,
-                                                     hour, minu, sec, year))
-        print('\t' + lines[3] + '\n')
-        f.close()
-
-
-def update_index():
-    # get index's content
-    file = open('.lgit/index', 'r')
-    lines = file.readlines()
+    t_stamp = datetime.datetime.fromtimestamp(timestamp).strftime(
+        "%Y%m%d%H%M%S")
+    year = t_stamp[:4]
+    month = t_stamp[4:6]
+    day = t_stamp[6:8]
+    hour = t_stamp[8:10]
+    minu = t_stamp[10:12]
+    sec = t_stamp[12:14]
+    weekday = calendar.weekday(int(year), int(month), int(day))
+    print('commit ' + tim)
+    print('Author: ' + author)
+    print('Date: {} {} {} {}:{}:{} {} \n'.format(weekdays[weekday],
+                                                 months[month], day,
+                                                 hour, minu, sec, year))
+    print('\t' + message.split('\n')[0] + '\n\n')
+
+
+def iter_log(branch=None, max_count=None, since=None, author=None):
+    # yield the commits of a branch, newest first, as dictionaries
+    update_log_index()
+    update_commit_graph()
+    if branch is None:
+        branch = get_current_branch()
+    # nothing to show before the first commit
+    if get_branch_commit(branch) is None and branch == get_current_branch():
+        return
+    graph = open_records('.lgit/commit-graph')
+    records = open_records('.lgit/log/index')
+    messages = open('.lgit/log/messages', 'rb')
+    authors = read_log_authors()
+    # filters are checked against the records, commit files are never read
+    author_ids = None
+    if author is not None:
+        author_ids = set(i for i, name in enumerate(authors) if author in name)
+    count = 0
+    try:
+        for position in walk_commits(graph, [resolve_commit(graph, branch)]):
+            if max_count is not None and count >= max_count:
+                break
+            tim = read_graph_record(graph, position)[0]
+            record = find_record(records, LOG_RECORD, tim)
+            if record is None:
+                raise LgitError('fatal: commit %s has no log record' % tim)
+            name, timestamp, author_id, offset, length = \
+                LOG_RECORD.unpack_from(records, record * LOG_RECORD.size)
+            # commits come newest first, older ones cannot match either
+            if since is not None and timestamp < since:
+                break
+            if author_ids is None or author_id in author_ids:
+                messages.seek(offset)
+                yield {'commit': tim, 'timestamp': timestamp,
+                       'author': authors[author_id],
+                       'message': messages.read(length).decode()}
+                count += 1
+    finally:
+        messages.close()
+
+
+def lgit_log(repo, branch=None, max_count=None, since=None, author=None):
+    try:
+        for commit in repo.log(branch, max_count, since, author):
+            print_commit(commit['commit'], commit['timestamp'],
+                         commit['author'], commit['message'])
+    except BrokenPipeError:
+        # the reader, e.g. `| head`, has seen enough
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+
+def update_index(jobs=1, write=True):
+    # without write the index is only refreshed in memory, status does so
+    # when another command holds the index lock
+    index = read_index()
+    index_mtime = os.stat('.lgit/index').st_mtime_ns
+
+    # with a running fsmonitor only the files it saw change, and the ones
+    # whose stat data is not trusted, are checked
+    names = index
+    changes = query_fsmonitor()
+    if changes is not None:
+        names = get_fsmonitor_names(index, changes[1], index_mtime)
+
+    # only files whose stat data changed are rehashed
+    stale = []
+    deleted = False
+    with trace_phase('stat'):
+        for name in names:
+            entry = index[name]
+            try:
+                stat = get_stale_stat(name, entry, index_mtime)
+            except FileNotFoundError:
+                if entry['working']:
+                    entry['working'] = ''
+                    entry['stat'] = None
+                    deleted = True
+                continue
+            if stat:
+                stale.append((name, stat))
+    if stale:
+        with trace_phase('hash'):
+            results = run_jobs(get_hash, [name for name, stat in stale],
+                               jobs)
+        for (name, stat), hash_value in zip(stale, results):
+            index[name]['working'] = hash_value
+            index[name]['stat'] = stat
+    if stale or deleted:
+        if write:
+            write_index(index)
+    if changes is not None and write:
+        save_fsmonitor_token(changes[0])
+
+
+def read_snapshot(snapshot_id):
+    # get {path: hash} of the files saved in a snapshot, which lists them
+    # or, since trees, only names the tree holding them
+    snapshot = {}
+    file = open('.lgit/snapshots/%s' % snapshot_id, 'r')
+    for line in file:
+        hash_value, name = line.rstrip('\n').split(' ', 1)
+        if hash_value == 'tree':
+            snapshot = read_tree_files(name)
+            break
+        snapshot[name] = hash_value
     file.close()
+    return snapshot
 
-    # update index file
-    fd = os.open('.lgit/index', os.O_WRONLY)
-    os.lseek(fd, 0, 0)
-    for line in lines:
-        name = line[138:-1]
-        content, hash_value = get_hash(name)
-        tim = datetime.datetime.fromtimestamp(os.stat(name).st_mtime)
-        tstamp = tim.strftime("%Y%m%d%H%M%S")
-        os.write(fd, bytes(tstamp + ' ' + hash_value, 'utf-8'))
-        os.lseek(fd, len(line) - 55, 1)
-    os.close(fd)
+
+def remove_working_file(file_name):
+    os.remove(file_name)
+    # if there is any empty directory, remove it
+    try:
+        while '/' in file_name:
+            file_name = file_name.rsplit('/', 1)[0]
+            os.rmdir(file_name)
+    except OSError:
+        pass
+
+
+def get_snapshot_changes(index, snapshot):
+    # get the changes making the index match a whole snapshot
+    changes = dict.fromkeys(index)
+    changes.update(snapshot)
+    return changes
+
+
+# progress is shown on a terminal for operations on at least this many files
+PROGRESS_MIN = 1000
+progress_lock = threading.Lock()
+
+
+def show_progress(title, done, total):
+    # report how far a long operation on total files is on a terminal, each
+    # time the percentage changes
+    if total < PROGRESS_MIN or not sys.stderr.isatty():
+        return
+    percent = done * 100 // total
+    if done == total or percent != (done - 1) * 100 // total:
+        sys.stderr.write('\r%s: %3d%% (%d/%d)%s' % (
+            title, percent, done, total, ', done.\n' if done == total else ''))
+        sys.stderr.flush()
+
+
+def write_working_file(progress, item):
+    # write a file for update_working_files() and count it in progress,
+    # {'done': files written, 'total': files to write}
+    file_name, hash_value = item
+    copy_object(hash_value, file_name)
+    st = os.stat(file_name)
+    with progress_lock:
+        progress['done'] += 1
+        show_progress('Updating files', progress['done'], progress['total'])
+    return st
+
+
+def update_working_files(index, changes, jobs=1):
+    # apply changes, {path: hash or None to remove the file}, to the working
+    # directory and the index: files whose content is already right are
+    # left alone, with their mtime. Directories are made first, then up to
+    # jobs threads write the files
+    with trace_phase('checkout_files'):
+        for file_name, hash_value in changes.items():
+            if hash_value is None:
+                if os.path.lexists(file_name):
+                    remove_working_file(file_name)
+                index.pop(file_name, None)
+
+        items = []
+        for file_name, hash_value in changes.items():
+            if hash_value is None:
+                continue
+            entry = index.get(file_name)
+            if (entry and entry['working'] == hash_value and
+                    os.path.lexists(file_name)):
+                entry['staged'] = hash_value
+                entry['committed'] = hash_value
+                continue
+            items.append((file_name, hash_value))
+        for dir_name in sorted({os.path.dirname(name) for name, hash_value
+                                in items} - {''}):
+            os.makedirs(dir_name, exist_ok=True)
+
+        progress = {'done': 0, 'total': len(items)}
+        results = run_jobs(functools.partial(write_working_file, progress),
+                           items, jobs)
+        for (file_name, hash_value), st in zip(items, results):
+            index[file_name] = new_index_entry(hash_value, st, hash_value)
+    write_index(index)
+
+
+def get_commit_changes(index, old_commit, new_commit):
+    # get the changes from old_commit, which the index matches, to
+    # new_commit; comparing their trees skips the unchanged directories
+    old_tree = read_commit_trailer(old_commit)[1]
+    new_tree = read_commit_trailer(new_commit)[1]
+    if old_tree is None or new_tree is None:
+        return get_snapshot_changes(index, read_commit_files(new_commit))
+    return {name: new for name, (old, new)
+            in diff_trees(old_tree, new_tree).items()}
 
 
 def print_errors_checkout(errors):
@@ -393,140 +2838,92 @@ def print_errors_checkout(errors):
     print('Aborting')
 
 
-def lgit_checkout(branch_name):
-    branch_list = os.listdir('.lgit/refs/heads')
-    if branch_list:
-        if branch_name in branch_list:
-            # get current branch name
-            head_file = open('.lgit/HEAD', 'r')
-            head_content = head_file.read()
-            head_file.close()
-            cur_branch = head_content.strip('\n').split('/')[-1]
+def switch_branch(index, branch_name, jobs=1):
+    # make branch_name the current branch, updating the files which differ
+    # between the two branches; return False if it already is
+    branch_list = get_branches()
+    if not branch_list:  # if call checkout without ever have commited yet
+        raise LgitError('fatal: You are on a branch yet to be born')
+    if branch_name not in branch_list:  # if branch name doesn't exist
+        raise LgitError('error: pathspec \'%s\' did not match '
+                        'any file(s) known to git.' % branch_name)
+    cur_branch = get_current_branch()
+    if branch_name == cur_branch:
+        return False
+
+    # if the last commit of branch_name is the same as the current
+    # branch's, nothing has changed with working files
+    last_commit = get_branch_commit(branch_name)
+    cur_commit = get_branch_commit(cur_branch)
+    if last_commit != cur_commit:
+        # if there is any file has change without commit
+        errors = []
+        for file_name, entry in index.items():
+            if entry['working'] != entry['committed']:
+                errors.append(file_name)
+        if errors:
+            raise CheckoutConflict(errors)
+        # change current branch, only the files that differ between the
+        # two commits are touched
+        update_working_files(index, get_commit_changes(
+            index, cur_commit, last_commit), jobs)
+
+    # change content of file HEAD
+    lock_file('.lgit/HEAD')
+    write_file('.lgit/HEAD', ('ref: refs/heads/%s' % branch_name).encode())
+    unlock_file('.lgit/HEAD')
+    return True
+
+
+def create_branch(branch_name):
+    # create a branch at the current commit
+    # if call branch without ever have commited yet
+    if not get_branches():
+        raise LgitError('fatal: Not a valid object name: \'master\'.')
+    ref_path = '.lgit/refs/heads/' + branch_name
+    lock_file(ref_path)
+    # if branch name exists
+    if os.path.exists(ref_path):
+        unlock_file(ref_path)
+        raise LgitError('fatal: A branch named \'%s\' already exists.'
+                        % branch_name)
+    commit = get_branch_commit(get_current_branch())
+    if commit is None:
+        unlock_file(ref_path)
+        raise LgitError('fatal: Not a valid object name: \'%s\'.'
+                        % get_current_branch())
+    write_file(ref_path, commit.encode())
+    unlock_file(ref_path)
+    return commit
+
+
+def lgit_checkout(repo, branch_name):
+    try:
+        switched = repo.checkout(branch_name)
+    except CheckoutConflict as conflict:
+        print_errors_checkout(conflict.paths)
+        exit()
+    if switched:
+        print('Switched to branch \'%s\'' % branch_name)
+    else:
+        print('Already on \'%s\'' % branch_name)
 
-            if branch_name == cur_branch:
-                print('Already on \'%s\'' % branch_name)
-            else:
-                # get the last commit of branch name
-                last_commit = open('.lgit/refs/heads/%s' % branch_name, 'r')\
-                    .readline().strip('\n')
-                # if it is the same as current branch, \
-                #   nothing has change with working files
-                if last_commit != open('.lgit/refs/heads/%s' % cur_branch,
-                                       'r').readline().strip('\n'):
-                    # check index's content
-                    index_file = open('.lgit/index', 'r')
-                    index_content = index_file.readlines()
-                    index_file.close()
-
-                    # if there is any file has change without commit
-                    errors = []
-                    for line in index_content:
-                        file_name = line[138:-1]
-                        cur_hash = line[15:55]
-                        commit_hash = line[97:137]
-                        if cur_hash != commit_hash:
-                            errors.append(file_name)
-                    if errors:  # print list of changed files
-                        print_errors_checkout(errors)
-                        exit()
-
-                    # change current branch
-                    else:
-                        # remove all files in index_file
-                        for line in index_content:
-                            file_name = line[138:-1]
-                            os.remove(file_name)
-                            # if there is any empty directory, remove it
-                            try:
-                                while '/' in file_name:
-                                    file_name = '/'.join(file_name.
-                                                         split('/')[:-1])
-                                    os.rmdir(file_name)
-                                os.rmdir(file_name)
-                            except OSError:
-                                pass
-
-                        # rewrite index file and create new working files
-                        new_index_content = ''
-                        snap_file = open('.lgit/snapshots/%s'
-                                         % last_commit, 'r')
-                        new_files = snap_file.readlines()
-                        for line in new_files:
-                            new_content = open('.lgit/objects/%s/%s' % (
-                                line[:2], line[2:40]), 'r').read()
-                            new_name = line[41:-1]
-
-                            # create new working file
-                            try:
-                                if '/' in new_name:
-                                    dirs_to_create = new_name.split('/')[:-1]
-                                    for i in range(len(dirs_to_create)-1):
-                                        os.mkdir('/'.join
-                                                 (dirs_to_create[:i+1]))
-                            except FileExistsError:
-                                pass
-                            new_file = open(new_name, 'w+')
-                            new_file.write(new_content)
-                            mtime = os.stat(new_name).st_mtime
-                            tim = datetime.datetime.fromtimestamp(mtime)
-                            new_timestamp = tim.strftime("%Y%m%d%H%M%S")
-                            new_file.close()
-                            new_index_content += (new_timestamp +
-                                                  (' ' + line[:40]) * 3 + ' ' +
-                                                  new_name + '\n')
-                        open('.lgit/index', 'w').write(new_index_content)
-
-                # change content of file HEAD
-                head_file = open('.lgit/HEAD', 'w')
-                head_file.write('ref: refs/heads/%s' % branch_name)
-                head_file.close()
-                print('Switched to branch \'%s\'' % branch_name)
-        else:  # if branch name doesn't exist
-            exit('error: pathspec \'%s\' did not match'
-                 'any file(s) known to git.' % branch_name)
-    else:  # if call checkout without ever have commited yet
-        exit('fatal: You are on a branch yet to be born')
-
-
-def lgit_branch(args):
-    if len(args) == 3:
-        # if call branch without ever have commited yet
-        if len(os.listdir('.lgit/refs/heads')) == 0:
-            exit('fatal: Not a valid object name: \'master\'.')
-
-        branch_name = args[-1]
-        # if branch name exists
-        if os.path.exists('.lgit/refs/heads/' + branch_name):
-            exit('fatal: A branch named \'%s\' already exists.' % branch_name)
-
-        # create new branch
-        snapshots = os.listdir('.lgit/snapshots')
-        fd = open('.lgit/refs/heads/%s' % branch_name, 'w')
-        if snapshots:
-            fd.write(max(snapshots))
-        fd.close()
 
+def lgit_branch(repo, args):
+    if len(args) == 3:
+        repo.create_branch(args[-1])
     elif len(args) < 3:  # if branch is called without parameters
-        head_file = open('.lgit/HEAD', 'r')
-        head_content = head_file.read()
-        head_file.close()
-        heads_files = os.listdir('.lgit/refs/heads')
         # print list branches
-        for file in heads_files:
-            if file == head_content.strip('\n').split('/')[-1]:
-                print('* ' + file)
+        for branch in repo.branches():
+            if branch == repo.current_branch:
+                print('* ' + branch)
             else:
-                print('  ' + file)
+                print('  ' + branch)
 
 
-def lgit_stash():
-    '''Saved working directory and index state WIP on master: b0f7304 acb
-    HEAD is now at b0f7304 acb'''
-
-    # get index's content
-    file_index = open('.lgit/index', 'r')
-    lines = file_index.readlines()
-    file_index.close()
+def stash_changes(index, jobs=1):
+    # save the staged files as a snapshot and take the working directory
+    # back to the last commit; return {'branch', 'commit', 'message'}
 
     # get timestamp
     tim = datetime.datetime.fromtimestamp(time.time())
@@ -542,13 +2939,14 @@ def lgit_stash():
     last_commit = open('.lgit/refs/heads/%s' % cur_branch, 'r') \
         .readline().strip('\n')
 
-    # create a snapshot contain current working flies' info
-    for line in lines:
-        hash_value = line[56:96]
-        name = line[138:]
-        snapshot = open('.lgit/snapshots/%s' % ms_timestamp, 'a+')
-        snapshot.write(hash_value + ' ' + name)
-        snapshot.close()
+    # create a snapshot naming the tree of the staged files
+    commit_tree = read_commit_trailer(last_commit)[1]
+    tree = write_trees(build_trees(
+        {name: entry['staged'] for name, entry in index.items()}),
+        commit_tree)
+    snapshot = open('.lgit/snapshots/%s' % ms_timestamp, 'w')
+    snapshot.write('tree %s\n' % tree)
+    snapshot.close()
 
     # create a file contains stashes
     ms = open('.lgit/commits/%s' % last_commit, 'r').readlines()[3].strip('\n')
@@ -557,10 +2955,6 @@ def lgit_stash():
                                    last_commit[:7], ms))
     stashes.close()
 
-    print('Saved working directory and index state WIP on %s: %s %s'
-          % (cur_branch, last_commit[:7], ms))
-    print('HEAD is now at %s %s' % (last_commit[:7], ms))
-
     # # create file COMMIT_EDITMSG
     # commit_msg = open('.lgit/commits/%s' % last_commit, 'r').readlines()[3]
     # commit_editmsg = open('.lgit/COMMIT_EDITMSG', 'w')
@@ -572,48 +2966,27 @@ def lgit_stash():
     # orig_head.write(last_commit)
     # orig_head.close()
 
-    # remove all files in index_file
-    for line in lines:
-        file_name = line[138:-1]
-        os.remove(file_name)
-        # if there is any empty directory, remove it
-        try:
-            while '/' in file_name:
-                file_name = '/'.join(file_name.
-                                     split('/')[:-1])
-                os.rmdir(file_name)
-            os.rmdir(file_name)
-        except OSError:
-            pass
+    # go back to the last commit, only touching files that differ from it:
+    # the staged files differing from it and the unstaged changes
+    if commit_tree is None:
+        changes = get_snapshot_changes(index, read_commit_files(last_commit))
+    else:
+        changes = {name: new for name, (old, new)
+                   in diff_trees(tree, commit_tree).items()}
+        for name, entry in index.items():
+            if name not in changes and entry['working'] != entry['staged']:
+                changes[name] = entry['committed'] or None
+    update_working_files(index, changes, jobs)
+    return {'branch': cur_branch, 'commit': last_commit, 'message': ms}
 
-    # rewrite index file and create new working files
-    new_index_content = ''
-    snap_file = open('.lgit/snapshots/%s' % last_commit, 'r')
-    new_files = snap_file.readlines()
-    for line in new_files:
-        new_content = open('.lgit/objects/%s/%s' % (
-            line[:2], line[2:40]), 'r').read()
-        new_name = line[41:-1]
 
-        # create new working file
-        try:
-            if '/' in new_name:
-                dirs_to_create = new_name.split('/')[:-1]
-                for i in range(len(dirs_to_create)-1):
-                    os.mkdir('/'.join
-                             (dirs_to_create[:i+1]))
-        except FileExistsError:
-            pass
-        new_file = open(new_name, 'w+')
-        new_file.write(new_content)
-        mtime = os.stat(new_name).st_mtime
-        tim = datetime.datetime.fromtimestamp(mtime)
-        new_timestamp = tim.strftime("%Y%m%d%H%M%S")
-        new_file.close()
-        new_index_content += (new_timestamp +
-                              (' ' + line[:40]) * 3 + ' ' +
-                              new_name + '\n')
-    open('.lgit/index', 'w').write(new_index_content)
+def lgit_stash(repo):
+    '''Saved working directory and index state WIP on master: b0f7304 acb
+    HEAD is now at b0f7304 acb'''
+    stash = repo.stash()
+    print('Saved working directory and index state WIP on %s: %s %s'
+          % (stash['branch'], stash['commit'][:7], stash['message']))
+    print('HEAD is now at %s %s' % (stash['commit'][:7], stash['message']))
 
 
 def lgit_stash_list():
@@ -636,6 +3009,427 @@ def lgit_stash_apply(stash_name):
     exit('not yet')
 
 
+def query_fsmonitor():
+    # ask the fsmonitor daemon which paths changed since the token saved by
+    # the last query, return (new token, paths) or None when there is no
+    # daemon or it cannot tell, and every file has to be checked
+    try:
+        file = open('.lgit/fsmonitor-token', 'r')
+        token = file.read().strip()
+        file.close()
+    except FileNotFoundError:
+        token = ''
+    reply = fsmonitor_request('query ' + token)
+    if reply is None:
+        return None
+    if reply.count('\n') < 2:
+        return None
+    token, state, paths = reply.split('\n', 2)
+    if state != 'ok':
+        # the daemon restarted or missed events, the new token is still
+        # good for the next query
+        return token, None
+    return token, [path for path in paths.split('\0') if path]
+
+
+def get_fsmonitor_names(index, paths, index_mtime):
+    # get the tracked files to check: the ones under the changed paths (a
+    # path ending with "/" is a whole directory) and the racily clean ones
+    if paths is None:
+        return index
+    names = set()
+    for path in paths:
+        if path.endswith('/'):
+            names.update(name for name in index if name.startswith(path))
+        elif path in index:
+            names.add(path)
+    for name, entry in index.items():
+        if entry['stat'] is None or entry['stat'][3] >= index_mtime:
+            names.add(name)
+    return sorted(names)
+
+
+def save_fsmonitor_token(token):
+    file = open('.lgit/fsmonitor-token', 'w')
+    file.write(token)
+    file.close()
+
+
+def fsmonitor_request(request):
+    # send a request to the daemon, None if it does not answer
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(FSMONITOR_TIMEOUT)
+    try:
+        client.connect(FSMONITOR_SOCKET)
+        client.sendall(request.encode() + b'\n')
+        client.shutdown(socket.SHUT_WR)
+        reply = []
+        data = client.recv(65536)
+        while data:
+            reply.append(data)
+            data = client.recv(65536)
+    except OSError:
+        return None
+    finally:
+        client.close()
+    return os.fsdecode(b''.join(reply))
+
+
+def add_inotify_watches(monitor, top):
+    # watch top and every directory below it, except .lgit
+    for dir_path, dir_names, file_names in os.walk(top):
+        if dir_path == './.lgit':
+            dir_names[:] = []
+            continue
+        wd = monitor['libc'].inotify_add_watch(
+            monitor['fd'], os.fsencode(dir_path), INOTIFY_MASK)
+        if wd < 0:
+            exit('fatal: cannot watch \'%s\': %s'
+                 % (dir_path, os.strerror(ctypes.get_errno())))
+        # './a/b' is kept as 'a/b', and '.' as ''
+        monitor['watches'][wd] = dir_path[2:]
+
+
+def remove_inotify_watches(monitor, top):
+    # a directory moved away keeps its watches, they would report the
+    # old paths
+    for wd, path in list(monitor['watches'].items()):
+        if path == top or path.startswith(top + '/'):
+            monitor['libc'].inotify_rm_watch(monitor['fd'], wd)
+            del monitor['watches'][wd]
+
+
+def mark_changed(monitor, path):
+    monitor['seq'] += 1
+    monitor['changes'][path] = monitor['seq']
+
+
+def read_inotify_events(monitor):
+    # record the path of every pending event with a new sequence number
+    while True:
+        try:
+            data = os.read(monitor['fd'], 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + INOTIFY_EVENT.size:
+                                    offset + INOTIFY_EVENT.size + length]
+                               .rstrip(b'\0'))
+            offset += INOTIFY_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost: every token given so far is stale
+                monitor['id'] = '%d.%d' % (os.getpid(), time.time_ns())
+                monitor['changes'] = {}
+                continue
+            if wd not in monitor['watches']:
+                continue
+            if mask & IN_IGNORED:
+                del monitor['watches'][wd]
+                continue
+            path = monitor['watches'][wd]
+            if name:
+                path = path + '/' + name if path else name
+            if path == '.lgit' or path.startswith('.lgit/'):
+                continue
+            if mask & IN_ISDIR:
+                if mask & (IN_DELETE | IN_MOVED_FROM):
+                    remove_inotify_watches(monitor, path)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    add_inotify_watches(monitor, './' + path)
+                mark_changed(monitor, path + '/')
+            else:
+                mark_changed(monitor, path)
+
+
+def answer_fsmonitor_query(monitor, request):
+    token = '%s:%d' % (monitor['id'], monitor['seq'])
+    daemon_id, sep, seq = request.partition(':')
+    if daemon_id != monitor['id'] or not seq.isdigit():
+        return token + '\nstale\n'
+    paths = [path for path, changed in monitor['changes'].items()
+             if changed > int(seq)]
+    return token + '\nok\n' + '\0'.join(paths)
+
+
+def run_fsmonitor():
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        exit('fatal: inotify is not available: %s'
+             % os.strerror(ctypes.get_errno()))
+    monitor = {'libc': libc, 'fd': fd, 'watches': {}, 'changes': {},
+               'seq': 0, 'id': '%d.%d' % (os.getpid(), time.time_ns())}
+    add_inotify_watches(monitor, '.')
+
+    if os.path.exists(FSMONITOR_SOCKET):
+        os.remove(FSMONITOR_SOCKET)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(FSMONITOR_SOCKET)
+    server.listen(16)
+    running = True
+    while running and os.path.isdir('.lgit'):
+        readable = select.select([fd, server], [], [], 1)[0]
+        if fd in readable:
+            read_inotify_events(monitor)
+        if server not in readable:
+            continue
+        client = server.accept()[0]
+        client.settimeout(FSMONITOR_TIMEOUT)
+        try:
+            request = client.makefile('rb').readline().decode().strip()
+            # events caused before the query was sent are already queued
+            read_inotify_events(monitor)
+            command, sep, argument = request.partition(' ')
+            if command == 'query':
+                client.sendall(os.fsencode(
+                    answer_fsmonitor_query(monitor, argument)))
+            elif command == 'quit':
+                running = False
+        except OSError:
+            pass
+        client.close()
+    server.close()
+    if os.path.exists(FSMONITOR_SOCKET):
+        os.remove(FSMONITOR_SOCKET)
+    os.close(fd)
+
+
+def lgit_fsmonitor(action):
+    if action == 'run':
+        run_fsmonitor()
+    elif action == 'start':
+        if fsmonitor_request('ping') is not None:
+            exit('fsmonitor is already running')
+        if os.fork():
+            # wait for the daemon to listen
+            for i in range(50):
+                if fsmonitor_request('ping') is not None:
+                    print('fsmonitor started')
+                    return
+                time.sleep(0.1)
+            exit('fatal: fsmonitor did not start')
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for std_fd in range(3):
+            os.dup2(devnull, std_fd)
+        run_fsmonitor()
+        os._exit(0)
+    elif action == 'stop':
+        if fsmonitor_request('quit') is None:
+            exit('fsmonitor is not running')
+        print('fsmonitor stopped')
+    else:
+        exit('usage: ./lgit.py fsmonitor (start | stop | run)')
+
+
+# the Repository open in this process, if any
+open_repository = None
+
+
+class Repository:
+    '''
+    An lgit repository opened once for many operations, e.g.
+
+        with lgit.Repository('work') as repo:
+            repo.add(paths)
+            repo.commit('message')
+            untracked = repo.status()['untracked']
+
+    The index, HEAD and branches are read when it is opened and the changes
+    to the index are written once, by flush() or when the with block ends
+    without error; checkout() is the exception, it writes the index at once
+    with the working files it changed, before HEAD moves. Failures raise
+    LgitError. lgit works relative to the current directory, so opening a
+    repository changes into it.
+
+    With write, the index lock is taken, waiting for other lgit commands
+    unless wait is False, and the index is refreshed from the working
+    files. Without it, the repository is read as it is on disk and the
+    methods changing it raise LgitError.
+
+    The state it works on, the current directory and the caches of the
+    index, config and objects, belongs to the process, so only one
+    repository can be open at a time: close it before opening another.
+    '''
+
+    def __init__(self, path='.', jobs=1, write=True, wait=True):
+        global open_repository
+        if open_repository is not None:
+            raise LgitError('fatal: another repository is open in this '
+                            'process, close it first')
+        os.chdir(path)
+        if not os.path.exists('.lgit'):
+            raise LgitError('fatal: not a git repository (or any of the '
+                            'parent directories)')
+        reset_caches()
+        self.jobs = jobs
+        self.locked = False
+        try:
+            if write:
+                self.locked = lock_file('.lgit/index', wait)
+                with trace_phase('update_index'):
+                    update_index(jobs, self.locked)
+            self.index = read_index()
+            self.current_branch = get_current_branch()
+            self.refs = {branch: get_branch_commit(branch)
+                         for branch in get_branches()}
+        except BaseException:
+            if self.locked:
+                unlock_file('.lgit/index')
+            raise
+        self.dirty = False
+        open_repository = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        global open_repository
+        if error_type is None:
+            self.close()
+            return
+        if self.locked:
+            # the changes to the index are dropped, the files remove()
+            # and checkout() changed stay as they are
+            unlock_file('.lgit/index')
+            self.locked = False
+        if open_repository is self:
+            open_repository = None
+
+    def check_locked(self):
+        # fail before a change is made to a repository opened without write
+        if not self.locked:
+            raise LgitError('fatal: the index is not locked for writing')
+
+    def add(self, paths):
+        # return the paths of the files whose content was staged
+        self.check_locked()
+        names = stage_files(self.index, paths, self.jobs)
+        self.dirty = True
+        return names
+
+    def remove(self, paths):
+        # remove the files which can be, from the working directory and the
+        # index, and return the error messages of the others
+        self.check_locked()
+        errors = remove_files(self.index, paths)
+        self.dirty = True
+        return errors
+
+    def commit(self, message):
+        # return the name of the new commit
+        self.check_locked()
+        commit = make_commit(self.index, message)
+        self.refs[self.current_branch] = commit
+        self.dirty = True
+        return commit
+
+    def status(self):
+        # return {'to_be_committed': [...], 'not_staged': [...],
+        # 'deleted': [...] (the not staged files deleted),
+        # 'untracked': [...]}
+        return get_status(self.index)
+
+    def files(self):
+        # iterate over the tracked paths in order; the index is read sorted
+        # so they are only sorted again after changes
+        if self.dirty:
+            return iter(sorted(self.index))
+        return iter(self.index)
+
+    def log(self, branch=None, max_count=None, since=None, author=None):
+        # return the commits as {'commit', 'timestamp', 'author', 'message'}
+        # dictionaries, newest first
+        return iter_log(branch, max_count, since, author)
+
+    def branches(self):
+        return list(self.refs)
+
+    def create_branch(self, name):
+        self.check_locked()
+        self.refs[name] = create_branch(name)
+
+    def checkout(self, branch):
+        # return False if branch already is the current one
+        self.check_locked()
+        switched = switch_branch(self.index, branch, self.jobs)
+        self.current_branch = branch
+        return switched
+
+    def stash(self):
+        # save the staged files and go back to the last commit, the index
+        # is written at once like checkout() does; return {'branch',
+        # 'commit', 'message'} of the commit gone back to
+        self.check_locked()
+        return stash_changes(self.index, self.jobs)
+
+    def diff(self, names=(), cached=False):
+        # yield (name, old hash, new hash, old blocks, new blocks) for the
+        # changed files, see iter_file_diffs()
+        return iter_file_diffs(self.index, names, cached)
+
+    def merge_base(self, first, second):
+        # return the best common ancestor of two commits or branches, None
+        # if there is none
+        return get_merge_base(first, second)
+
+    def is_ancestor(self, first, second):
+        return check_ancestor(first, second)
+
+    def gc(self):
+        # return {'objects': count, 'deltas': count, 'pack': name or None}
+        self.check_locked()
+        return pack_objects()
+
+    def set_config(self, name, value):
+        # the config is not guarded by the index lock
+        set_config(name, value)
+
+    def flush(self):
+        if not self.dirty:
+            return
+        self.check_locked()
+        write_index(self.index)
+        self.dirty = False
+
+    def unlock(self):
+        # write the index and release its lock; the repository can still
+        # be read but no longer changed
+        self.flush()
+        if self.locked:
+            unlock_file('.lgit/index')
+            self.locked = False
+
+    def close(self):
+        global open_repository
+        self.unlock()
+        if open_repository is self:
+            open_repository = None
+
+
+def reset_caches():
+    # forget what was read from another repository
+    global cached_index, cached_config, cached_hash
+    cached_index = None
+    cached_config = None
+    cached_hash = None
+    reset_packs()
+
+
+def pop_option(args, option, default=None):
+    # remove "option value" from args and return the value
+    if option not in args:
+        return default
+    i = args.index(option)
+    if i + 1 == len(args):
+        exit('fatal: option \'%s\' requires a value' % option)
+    value = args[i + 1]
+    del args[i:i + 2]
+    return value
+
+
 def main():
     args = sys.argv
 
@@ -652,61 +3446,135 @@ def main():
     curpath = ''.join(curpath.split(mainpath))
 
     # get options
+    try:
+        jobs = int(pop_option(args, '-j', os.cpu_count() or 1))
+    except ValueError:
+        exit('fatal: -j expects a number of jobs')
+    hash_name = pop_option(args, '--hash', 'sha1')
     command = args[1]
+    trace = '--trace' in args
+    if trace:
+        args.remove('--trace')
+    start_trace(command, '1' if trace else os.getenv('LGIT_TRACE', ''))
     if command == 'init':
-        lgit_init()
-    else:
-        # If there is not a .lgit dir, lgit.py will exit with a fatal error.
-        if not os.path.exists('.lgit'):
-            print('fatal: not a git repository ('
-                  'or any of the parent directories)')
-            exit()
-        update_index()
-        if command == 'rm':
-            temp = args[2:]
-            filenames = []
+        try:
+            lgit_init(hash_name)
+        except LgitError as error:
+            exit(str(error))
+        return
+    # If there is not a .lgit dir, lgit.py will exit with a fatal error.
+    if not os.path.exists('.lgit'):
+        print('fatal: not a git repository ('
+              'or any of the parent directories)')
+        exit()
+    try:
+        # status and diff do not wait for the lock, they only refresh the
+        # index on disk when no other command is changing it, then let it
+        # go before walking the working directory or writing output
+        # creating a branch changes the repository, listing them does not
+        write = (command not in READ_ONLY_COMMANDS or
+                 command == 'branch' and len(args) == 3)
+        repo = Repository('.', jobs, write=write,
+                          wait=command not in ['status', 'diff'])
+        with repo:
+            if command in ['status', 'diff']:
+                repo.unlock()
+            run_command(repo, command, args, curpath)
+    except LgitError as error:
+        exit(str(error))
+
+
+def run_command(repo, command, args, curpath):
+    zero = '-z' in args
+    if zero:
+        args.remove('-z')
+    stdin = '--stdin' in args
+    if stdin:
+        args.remove('--stdin')
+    if command in ['add', 'rm'] and stdin:
+        # the paths are read from stdin, the index is changed once
+        filenames = [curpath + name for name in read_stdin_paths(zero)]
+        if command == 'add':
+            lgit_add(repo, filenames)
+        else:
+            lgit_rm(repo, filenames)
+    elif command == 'rm':
+        temp = args[2:]
+        filenames = []
+        for name in temp:
+            filenames.append(curpath + name)
+        lgit_rm(repo, filenames)
+    elif command == 'add':
+        temp = args[2:]
+        filenames = []
+        if '.' in temp and curpath != '':
+            scan = os.scandir(curpath)
+            for e in scan:
+                filenames.append(curpath + e.name)
+        else:
             for name in temp:
                 filenames.append(curpath + name)
-            lgit_rm(filenames)
-        elif command == 'add':
-            temp = args[2:]
-            filenames = []
-            if '.' in temp and curpath != '':
-                scan = os.scandir(curpath)
-                for e in scan:
-                    filenames.append(curpath + e.name)
-            else:
-                for name in temp:
-                    filenames.append(curpath + name)
-            lgit_add(filenames)
-        elif command == 'commit':
-            if '-m' not in args:
-                print('Please enter a commit message with -m')
-                exit()
+        lgit_add(repo, filenames)
+    elif command == 'commit':
+        if '-m' not in args:
+            print('Please enter a commit message with -m')
+            exit()
+        else:
+            lgit_commit(repo, args[-1])
+    elif command == 'status':
+        lgit_status(repo)
+    elif command == 'ls-files':
+        lgit_ls_file(repo, curpath, zero)
+    elif command == 'config':
+        if '--author' in args:
+            lgit_config_author(repo, args[-1])
+        elif len(args) == 4:
+            lgit_config(repo, args[2], args[3])
+        else:
+            exit('usage: ./lgit.py config (--author <name> | '
+                 '<section.key> <value>)')
+    elif command == 'log':
+        max_count = pop_option(args, '-n')
+        since = pop_option(args, '--since')
+        try:
+            if max_count is not None:
+                max_count = int(max_count)
+            if since is not None:
+                since = datetime.datetime.fromisoformat(since).timestamp()
+        except ValueError:
+            exit('fatal: -n expects a number and --since a date '
+                 'like 2018-11-26 or "2018-11-26 14:30"')
+        author = pop_option(args, '--author')
+        branch = args[2] if len(args) > 2 else None
+        lgit_log(repo, branch, max_count, since, author)
+    elif command == 'diff':
+        cached = '--cached' in args
+        if cached:
+            args.remove('--cached')
+        lgit_diff(repo, args[2:], cached)
+    elif command == 'merge-base':
+        ancestor = '--is-ancestor' in args
+        if ancestor:
+            args.remove('--is-ancestor')
+        lgit_merge_base(repo, args[2:], ancestor)
+    elif command == 'branch':
+        lgit_branch(repo, args)
+    elif command == 'checkout':
+        if len(args) > 2:
+            lgit_checkout(repo, args[-1])
+    elif command == 'fsmonitor':
+        lgit_fsmonitor(args[2] if len(args) > 2 else 'start')
+    elif command in ['gc', 'repack']:
+        lgit_gc(repo)
+    elif command == 'stash':
+        if len(args) == 2:
+            lgit_stash(repo)
+        elif len(args) > 2:
+            ops = args[2]
+            if ops == 'list':
+                lgit_stash_list()
             else:
-                lgit_commit(args[-1])
-        elif command == 'status':
-            lgit_status()
-        elif command == 'ls-files':
-            lgit_ls_file(curpath)
-        elif command == 'config':
-            lgit_config_author(args[-1])
-        elif command == 'log':
-            lgit_log()
-        elif command == 'branch':
-            lgit_branch(args)
-        elif command == 'checkout':
-            if len(args) > 2:
-                lgit_checkout(args[-1])
-        elif command == 'stash':
-            if len(args) == 2:
-                lgit_stash()
-            elif len(args) > 2:
-                ops = args[2]
-                if ops == 'list':
-                    lgit_stash_list()
-                else:
-                    lgit_stash_apply(args[3])
+                lgit_stash_apply(args[3])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import lgit  # noqa: E402
+
+
+@pytest.fixture
+def repo_dir(tmp_path, monkeypatch):
+    # an empty repository as the current directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('LOGNAME', 'tester')
+    lgit.reset_caches()
+    lgit.lgit_init()
+    return tmp_path
+
+
+def write(name, content):
+    if os.path.dirname(name):
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+    file = open(name, 'w')
+    file.write(content)
+    file.close()
@@ -0,0 +1,29 @@
+import random
+
+import lgit
+
+
+def test_delta_round_trip():
+    rand = random.Random(0)
+    words = [b'alpha', b'beta', b'gamma', b'delta', b'epsilon\n', b'\n']
+    for i in range(200):
+        base = b' '.join(rand.choice(words)
+                         for j in range(rand.randint(0, 300)))
+        lines = base.splitlines(True)
+        # drop, change and insert some lines
+        for j in range(rand.randint(0, 10)):
+            position = rand.randint(0, len(lines))
+            if rand.random() < 0.5 and position < len(lines):
+                del lines[position]
+            else:
+                lines.insert(position, rand.choice(words) * rand.randint(1, 4))
+        target = b''.join(lines)
+        assert lgit.apply_delta(base, lgit.make_delta(base, target)) == target
+
+
+def test_delta_of_unrelated_content():
+    base = bytes(range(256)) * 4
+    target = b'nothing in common\nat all'
+    assert lgit.apply_delta(base, lgit.make_delta(base, target)) == target
+    assert lgit.apply_delta(b'', lgit.make_delta(b'', target)) == target
+    assert lgit.apply_delta(base, lgit.make_delta(base, b'')) == b''
@@ -0,0 +1,63 @@
+import io
+import random
+import subprocess
+import sys
+
+import lgit
+
+
+def make_lines(rand, count):
+    words = ['a', 'b', 'c', 'd', '{', '}', 'return x;', '']
+    return [rand.choice(words) + '\n' for i in range(count)]
+
+
+def edit(rand, lines):
+    lines = list(lines)
+    for i in range(rand.randint(0, 8)):
+        position = rand.randint(0, len(lines))
+        action = rand.random()
+        if action < 0.4 and position < len(lines):
+            del lines[position:position + rand.randint(1, 5)]
+        elif action < 0.7 and position < len(lines):
+            lines[position] = 'changed %d\n' % i
+        else:
+            lines[position:position] = make_lines(rand, rand.randint(1, 5))
+    return lines
+
+
+def get_diff(monkeypatch, old, new):
+    out = io.BytesIO()
+    monkeypatch.setattr(sys, 'stdout', io.TextIOWrapper(out))
+    lgit.print_file_diff('f', 'old' if old else None, 'new' if new else None,
+                         [old], [new])
+    return out.getvalue()
+
+
+def test_diff_round_trips_through_patch(tmp_path, monkeypatch):
+    rand = random.Random(1)
+    for i in range(150):
+        old = ''.join(make_lines(rand, rand.randint(0, 60)))
+        new = ''.join(edit(rand, old.splitlines(True)))
+        # sometimes without a newline at the end
+        if rand.random() < 0.2:
+            old = old.rstrip('\n')
+        if rand.random() < 0.2:
+            new = new.rstrip('\n')
+        if not old or not new or old == new:
+            continue
+        diff = get_diff(monkeypatch, old.encode(), new.encode())
+        path = tmp_path / 'f'
+        path.write_text(old)
+        subprocess.run(['patch', '-s', '-f', str(path)], input=diff,
+                       check=True)
+        assert path.read_text() == new, diff.decode()
+
+
+def test_diff_of_identical_content_has_no_hunk(monkeypatch):
+    diff = get_diff(monkeypatch, b'same\n', b'same\n')
+    assert b'@@' not in diff
+
+
+def test_binary_files_are_not_diffed(monkeypatch):
+    diff = get_diff(monkeypatch, b'a\0b', b'a\0c')
+    assert diff.endswith(b'Binary files a/f and b/f differ\n')
@@ -0,0 +1,63 @@
+import lgit
+from conftest import write
+
+
+def ignored(path, is_dir=False):
+    dir_name = path.rsplit('/', 1)[0] if '/' in path else '.'
+    return lgit.is_ignored(lgit.get_ignore_rules(dir_name), path, is_dir)
+
+
+def test_anchored_patterns(repo_dir):
+    write('.lgitignore', '/build\ndocs/*.html\nname\n')
+    assert ignored('build', True)
+    assert ignored('build')
+    assert not ignored('src/build', True)
+    # a slash in the middle anchors too
+    assert ignored('docs/index.html')
+    assert not ignored('src/docs/index.html')
+    # without a slash a pattern matches at any depth
+    assert ignored('name')
+    assert ignored('a/b/name')
+
+
+def test_double_star(repo_dir):
+    write('.lgitignore', '**/cache\nlogs/**\na/**/z.txt\n')
+    assert ignored('cache', True)
+    assert ignored('x/y/cache', True)
+    assert ignored('logs/today.log')
+    assert ignored('logs/old/today.log')
+    assert not ignored('logs', True)
+    assert ignored('a/z.txt')
+    assert ignored('a/b/c/z.txt')
+    assert not ignored('b/a/z.txt')
+
+
+def test_negation(repo_dir):
+    write('.lgitignore', '*.log\n!keep.log\n')
+    assert ignored('x.log')
+    assert ignored('d/x.log')
+    assert not ignored('keep.log')
+    assert not ignored('d/keep.log')
+    # the last matching pattern wins
+    write('.lgitignore', '!keep.log\n*.log\n')
+    assert ignored('keep.log')
+
+
+def test_directory_only_patterns(repo_dir):
+    write('.lgitignore', 'out/\n')
+    assert ignored('out', True)
+    assert ignored('src/out', True)
+    assert not ignored('out')
+
+
+def test_nested_ignore_files(repo_dir):
+    write('.lgitignore', '*.tmp\n')
+    write('sub/.lgitignore', '!keep.tmp\n/local\n')
+    write('.lgit/info/exclude', 'secret\n')
+    assert ignored('sub/x.tmp')
+    assert not ignored('sub/keep.tmp')
+    assert ignored('keep.tmp')
+    # anchored to the directory of its ignore file
+    assert ignored('sub/local')
+    assert not ignored('local')
+    assert ignored('sub/secret')
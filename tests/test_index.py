@@ -0,0 +1,67 @@
+import lgit
+
+HASHES = ['%040x' % i for i in range(1, 5)]
+
+
+def test_binary_index_round_trip(repo_dir):
+    stat = (12, 34, 10 ** 18, 10 ** 18)
+    index = {
+        'a.txt': {'working': HASHES[0], 'staged': HASHES[0],
+                  'committed': HASHES[0], 'stat': stat},
+        'd/new file': {'working': HASHES[1], 'staged': HASHES[1],
+                       'committed': '', 'stat': None},
+        'd/modified': {'working': HASHES[2], 'staged': HASHES[3],
+                       'committed': HASHES[3], 'stat': stat},
+        'deleted': {'working': '', 'staged': HASHES[0],
+                    'committed': HASHES[0], 'stat': None},
+    }
+    lgit.write_index(index)
+    file = open('.lgit/index', 'rb')
+    content = file.read()
+    file.close()
+    assert content.startswith(lgit.INDEX_SIGNATURE)
+    parsed = lgit.parse_index(content)
+    assert parsed == index
+    assert list(parsed) == sorted(index)
+
+
+def test_racy_entries_lose_their_stat_data(repo_dir):
+    now = lgit.time.time_ns()
+    lgit.write_index({'a': {'working': HASHES[0], 'staged': HASHES[0],
+                            'committed': '', 'stat': (1, 2, now, now)}})
+    file = open('.lgit/index', 'rb')
+    assert lgit.parse_index(file.read())['a']['stat'] is None
+    file.close()
+
+
+def test_text_index_migration(repo_dir):
+    lines = [
+        '20200101000000 %s %s %s b.txt\n' % (HASHES[0], HASHES[1],
+                                             ' ' * 40),
+        '20200101000000 %s %s %s a b.txt\n' % (HASHES[2], HASHES[2],
+                                               HASHES[3]),
+    ]
+    index = lgit.parse_index(''.join(lines).encode())
+    assert list(index) == ['a b.txt', 'b.txt']
+    assert index['b.txt'] == {'working': HASHES[0], 'staged': HASHES[1],
+                              'committed': '', 'stat': None}
+    assert index['a b.txt']['committed'] == HASHES[3]
+
+    # the second text format has a header and stat data
+    content = lgit.TEXT_INDEX_HEADER + (
+        '20200101000000 %s %s %s 1 2 3 4 c.txt\n'
+        '20200101000000 %s %s %s - - - - d.txt\n'
+        % (HASHES[0], HASHES[0], HASHES[0], HASHES[1], HASHES[1], ' ' * 40))
+    index = lgit.parse_index(content.encode())
+    assert index['c.txt']['stat'] == (1, 2, 3, 4)
+    assert index['d.txt']['stat'] is None
+
+    # it is written back in the binary format
+    file = open('.lgit/index', 'w')
+    file.write(content)
+    file.close()
+    with lgit.Repository('.') as repo:
+        repo.dirty = True
+    file = open('.lgit/index', 'rb')
+    assert file.read().startswith(lgit.INDEX_SIGNATURE)
+    file.close()
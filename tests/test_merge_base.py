@@ -0,0 +1,32 @@
+import lgit
+from conftest import write
+
+
+def commit(repo, name, content):
+    write(name, content)
+    repo.add([name])
+    return repo.commit(content)
+
+
+def test_merge_base_of_branches(repo_dir):
+    with lgit.Repository('.') as repo:
+        root = commit(repo, 'f', 'root')
+        fork = commit(repo, 'f', 'fork')
+        repo.create_branch('topic')
+        for i in range(3):
+            commit(repo, 'f', 'master %d' % i)
+        repo.checkout('topic')
+        tip = commit(repo, 'g', 'topic')
+        repo.create_branch('side')
+        commit(repo, 'g', 'topic 2')
+
+    with lgit.Repository('.', write=False) as repo:
+        assert repo.merge_base('master', 'topic') == fork
+        assert repo.merge_base('topic', 'master') == fork
+        assert repo.merge_base('side', 'topic') == tip
+        assert (repo.merge_base('master', 'master') ==
+                lgit.get_branch_commit('master'))
+        assert repo.merge_base(root, 'side') == root
+        assert repo.is_ancestor('side', 'topic')
+        assert not repo.is_ancestor('topic', 'side')
+        assert not repo.is_ancestor('master', 'topic')
@@ -0,0 +1,35 @@
+import os
+
+import lgit
+from conftest import write
+
+
+def read(name):
+    file = open(name)
+    content = file.read()
+    file.close()
+    return content
+
+
+def test_cached_objects_are_not_read_from_their_files(repo_dir):
+    write('f', 'content\n')
+    hash_value = lgit.store_file('f')
+    lgit.read_object(hash_value)
+    # only object_cache still has the object
+    os.remove(lgit.get_object_path(hash_value))
+
+    assert b''.join(lgit.iter_object(hash_value)) == b'content\n'
+    lgit.copy_object(hash_value, 'g')
+    assert read('g') == 'content\n'
+
+
+def test_misses_are_counted_once(repo_dir):
+    write('f', 'other content\n')
+    hash_value = lgit.store_file('f')
+    stats = lgit.object_cache_stats.copy()
+
+    lgit.copy_object(hash_value, 'g')
+    assert read('g') == 'other content\n'
+    assert b''.join(lgit.iter_object(hash_value)) == b'other content\n'
+    assert lgit.object_cache_stats - stats == {'object_cache_misses': 1,
+                                               'object_cache_hits': 1}
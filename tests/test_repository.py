@@ -0,0 +1,41 @@
+import os
+
+import lgit
+from conftest import write
+
+
+def test_add_rehashes_files_changed_after_open(repo_dir):
+    write('t.txt', 'one\n')
+    with lgit.Repository('.') as repo:
+        repo.add(['t.txt'])
+        repo.commit('first')
+
+    with lgit.Repository('.') as repo:
+        write('t.txt', 'two, longer\n')
+        assert repo.add(['t.txt']) == ['t.txt']
+        assert repo.status()['to_be_committed'] == ['t.txt']
+
+
+def test_checkout_leaves_unchanged_files_alone(repo_dir):
+    write('same.txt', 'same\n')
+    write('d/changed.txt', 'old\n')
+    with lgit.Repository('.') as repo:
+        repo.add(['.'])
+        repo.commit('first')
+        repo.create_branch('old')
+    # an mtime in the past, a rewrite would change it
+    os.utime('same.txt', ns=(10 ** 18, 10 ** 18))
+    write('d/changed.txt', 'new\n')
+    with lgit.Repository('.') as repo:
+        repo.add(['.'])
+        repo.commit('second')
+
+    with lgit.Repository('.') as repo:
+        assert repo.checkout('old')
+    assert os.stat('same.txt').st_mtime_ns == 10 ** 18
+    assert open('d/changed.txt').read() == 'old\n'
+    with lgit.Repository('.') as repo:
+        assert repo.checkout('master')
+        assert repo.status()['not_staged'] == []
+    assert os.stat('same.txt').st_mtime_ns == 10 ** 18
+    assert open('d/changed.txt').read() == 'new\n'